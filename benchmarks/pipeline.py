@@ -0,0 +1,207 @@
+import argparse
+import os
+import tracemalloc
+from time import perf_counter, perf_counter_ns
+
+import toml
+
+from tourboxneo import Service
+from tourboxneo.config import Config
+from tourboxneo.loop import Loop
+from tourboxneo.reader import decode
+from tourboxneo.sinks import DeviceSink
+from tourboxneo.writer import Emitter, MemoryWriter
+
+# Drives decode -> dispatch -> emit with synthetic byte streams, without a
+# TourBox or /dev/uinput. Run from the repository root:
+#
+#     python -m benchmarks.pipeline [-n ROUNDS] [--only NAME]
+
+CONFIG = '''
+name = "Benchmark"
+
+[layouts.main.prime]
+side = "lctrl"
+top = "lshift"
+tall = "space"
+short = { action = "esc", kind = "up" }
+side_top = "C-S-z"
+
+[layouts.main.kit]
+up = "up"
+down = "down"
+top_up = "C-up"
+side_up = { action = "C-z", kind = "down" }
+
+[layouts.main.knob]
+turn = { action = "C-equal", reverse = "C-minus", rate = 3 }
+
+[layouts.main.scroll]
+turn = "wheel-"
+
+[layouts.main.dial]
+turn = { action = "hwheel", step = 0.5 }
+
+[shortcuts]
+[macros]
+[menus]
+'''
+
+STREAMS = {
+    # fast knob spin in both directions, as the device sends it
+    'knob_spin': bytes([0x04] * 32 + [0x44] * 32),
+    # scroll wheel burst, merged into single wheel events
+    'scroll_burst': bytes([0x09] * 64 + [0x49] * 64),
+    # held modifier chord: side (ctrl) + top (shift) + arrows
+    'held_chord': bytes([0x01, 0x02, 0x10, 0x90, 0x11, 0x91, 0x82, 0x81]),
+    # firmware combo bytes that clobber held prime buttons
+    'clobber': bytes([0x02, 0x2b, 0xab, 0x01, 0x02, 0x20, 0xa0, 0x82, 0x81]),
+    # kind = up/down buttons
+    'up_down': bytes([0x03, 0x83, 0x14, 0x94]),
+}
+
+
+ALLOC_ROUNDS = 50
+
+
+class Devnull:
+    def __init__(self, fd):
+        self.fd = fd
+
+    def close(self):
+        pass
+
+
+class StreamReader:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.index = 0
+
+    def read(self):
+        chunk = self.chunks[self.index]
+        self.index = (self.index + 1) % len(self.chunks)
+        return chunk
+
+
+def percentile(samples, p):
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def report(name, events, seconds, latencies, allocated):
+    latencies.sort()
+    p50, p90, p99 = (percentile(latencies, p) / 1000 for p in (.5, .9, .99))
+    print(f'{name:28} {events / seconds:12,.0f} ev/s  '
+          f'p50 {p50:6.2f}us  p90 {p90:6.2f}us  p99 {p99:6.2f}us  '
+          f'alloc {allocated:7.1f}B/ev')
+
+
+def make_service(config, writer):
+    service = Service(config, None, Loop())
+    service.writer = writer
+    return service
+
+
+def bench_decode(stream, rounds, latencies):
+    for _ in range(rounds):
+        t = perf_counter_ns()
+        decode(stream)
+        if latencies is not None:
+            latencies.append((perf_counter_ns() - t) / len(stream))
+    return len(stream) * rounds
+
+
+def bench_dispatch(service, stream, rounds, latencies):
+    dispatch = service.dispatch
+    syn = service.writer.syn
+    for _ in range(rounds):
+        for b in stream:
+            t = perf_counter_ns()
+            dispatch(b)
+            syn()
+            if latencies is not None:
+                latencies.append(perf_counter_ns() - t)
+    return len(stream) * rounds
+
+
+def bench_tick(service, stream, rounds, latencies):
+    # whole stream per read, as when the serial buffer is drained in bulk
+    service.reader = StreamReader([stream])
+    tick = service.tick
+    for _ in range(rounds):
+        t = perf_counter_ns()
+        tick()
+        if latencies is not None:
+            latencies.append((perf_counter_ns() - t) / len(stream))
+    return len(stream) * rounds
+
+
+def transient(run, rounds):
+    # most bytes one round held above where it started, and the events in
+    # that round. CPython keeps no count of allocations, only of what is
+    # alive, so this is the high-water mark of each round's temporaries
+    most = 0
+    for _ in range(rounds):
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        events = run(1, None)
+        most = max(most, tracemalloc.get_traced_memory()[1] - start)
+    return most, events
+
+
+def measure(name, run, idle, rounds):
+    # warm up, then trace allocations and time in separate passes so the
+    # latency samples themselves don't show up as allocations. idle is the
+    # same benchmark on an empty stream, whatever it holds is the harness's
+    # own, so a path that allocates nothing per event reports 0
+    run(1, None)
+
+    tracemalloc.start()
+    allocated, per_round = transient(run, ALLOC_ROUNDS)
+    allocated -= transient(idle, ALLOC_ROUNDS)[0]
+    tracemalloc.stop()
+
+    latencies = []
+    start = perf_counter()
+    events = run(rounds, latencies)
+    seconds = perf_counter() - start
+    report(name, events, seconds, latencies, max(allocated, 0) / per_round)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmarks.pipeline')
+    parser.add_argument('-n', '--rounds', type=int, default=2000)
+    parser.add_argument('--only', help='run streams whose name contains this')
+    args = parser.parse_args()
+
+    config = Config(toml.loads(CONFIG))
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    writers = {
+        'memory': lambda: MemoryWriter(keep=False),
+        # both uinput sinks write to the device fd
+        'fd': lambda: Emitter([DeviceSink(Devnull(devnull))]),
+    }
+
+    print(f'{"benchmark":28} {"throughput":>15}  latency per event')
+    for s_name, stream in STREAMS.items():
+        if args.only and args.only not in s_name:
+            continue
+        measure(f'decode/{s_name}',
+                lambda n, lat: bench_decode(stream, n, lat),
+                lambda n, lat: bench_decode(b'', n, lat), args.rounds)
+        for w_name, make_writer in writers.items():
+            service = make_service(config, make_writer())
+            measure(f'dispatch/{w_name}/{s_name}',
+                    lambda n, lat: bench_dispatch(service, stream, n, lat),
+                    lambda n, lat: bench_dispatch(service, b'', n, lat),
+                    args.rounds)
+            service = make_service(config, make_writer())
+            measure(f'tick/{w_name}/{s_name}',
+                    lambda n, lat: bench_tick(service, stream, n, lat),
+                    lambda n, lat: bench_tick(service, b'', n, lat),
+                    args.rounds)
+
+    os.close(devnull)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import heapq
+
+import pytest
+import toml
+
+from tourboxneo import Service
+from tourboxneo.config import Config
+from tourboxneo.loop import Timer
+from tourboxneo.writer import MemoryWriter
+
+
+# Loop time only moves when the test says so.
+class FakeLoop:
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.now + delay, callback, *args)
+
+    def remove_reader(self, fd):
+        return False
+
+    def advance(self, seconds):
+        until = self.now + seconds
+        while self.timers and self.timers[0].when <= until:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self.now = timer.when
+                timer.callback(*timer.args)
+        self.now = until
+
+
+class BatchReader:
+    def __init__(self, bs):
+        self.bs = bytes(bs)
+
+    def fileno(self):
+        return -1
+
+    def read(self):
+        return self.bs
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+# A Service on the fake loop, writing to memory; feed() hands it one read.
+class Rig:
+    def __init__(self, loop, config):
+        self.loop = loop
+        self.service = Service(config, None, loop)
+        self.service.writer = self.writer = MemoryWriter()
+
+    def feed(self, *bs):
+        self.service.reader = BatchReader(bs)
+        self.service.tick()
+
+    def unplug(self):
+        self.service.disconnect_input(RuntimeError, RuntimeError('unplugged'),
+                                      None)
+
+    def keys(self):
+        keys = [(code, value) for event, code, value in self.writer.events()
+                if event == 1]
+        self.writer.data.clear()
+        return keys
+
+
+@pytest.fixture
+def loop():
+    return FakeLoop()
+
+
+@pytest.fixture
+def make_rig(loop):
+    def make(config):
+        return Rig(loop, Config(toml.loads(config)))
+    return make
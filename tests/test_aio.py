@@ -0,0 +1,34 @@
+import asyncio
+
+from tourboxneo.aio import AsyncService
+from tourboxneo.config import Config
+from tourboxneo.sources import PtyReader
+from tourboxneo.writer import MemoryWriter
+
+TALL = 0x00
+
+
+def test_exit_ends_full_listeners_and_awaits_hooks():
+    async def main():
+        done = []
+        service = AsyncService(Config.from_file(None, cache=False),
+                               source=PtyReader, writer=MemoryWriter())
+        async with service:
+            @service.on_press
+            async def hook(btn, reverse):
+                await asyncio.sleep(0.01)
+                done.append(btn.key)
+
+            events = service.events(maxsize=1)
+            waiting = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(0)
+            service.publish(bytes([TALL, TALL | 0x80, TALL]))
+            first = await waiting
+            service.publish(bytes([TALL | 0x80, TALL]))  # fills the queue
+        rest = [event async for event in events]
+        return first, rest, done
+
+    first, rest, done = asyncio.run(main())
+    assert first[0].key == 'tall'
+    assert len(rest) <= 1
+    assert done == ['tall', 'tall', 'tall']
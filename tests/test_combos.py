@@ -0,0 +1,178 @@
+import logging
+
+import pytest
+
+from tourboxneo.combos import (Chord, ComboKey, DoubleTap, LongPress, FAIL,
+                               MATCH, WAIT)
+from tourboxneo.dispatch import logger as dispatch_logger, untraced
+from tourboxneo.reader import RELEASE_MASK
+
+SPACE, ESC, UP, Z, ENTER, TAB, MINUS = 57, 1, 103, 44, 28, 15, 12
+TALL, SHORT, KIT_UP, KNOB_PRESS = 0x00, 0x03, 0x10, 0x37
+KNOB_REVERSE = 0x44
+
+CONFIG = '''
+name = "combos"
+[layouts.main.prime]
+tall = "space"
+short = "esc"
+[layouts.main.kit]
+up = "up"
+[layouts.main.knob]
+press = "a"
+turn = {{ action = "equal", reverse = "minus" }}
+[layouts.main.combos]
+mode = "{mode}"
+[layouts.main.combos.undo]
+chord = ["kit.up", "knob.press"]
+action = "z"
+window = "100ms"
+[layouts.main.combos.dbl]
+double = "prime.tall"
+action = "enter"
+window = "100ms"
+[layouts.main.combos.lng]
+long = "prime.short"
+action = "tab"
+window = "100ms"
+[shortcuts]
+[macros]
+[menus]
+'''
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'traced'])
+def traced(request):
+    level = dispatch_logger.level
+    if request.param:
+        dispatch_logger.setLevel(logging.DEBUG)
+    yield request.param
+    dispatch_logger.setLevel(level)
+
+
+def release(b):
+    return b | RELEASE_MASK
+
+
+def test_chord_check():
+    chord = Chord('undo', [KIT_UP, KNOB_PRESS], None, 0.1)
+    assert chord.check([KIT_UP], False) == WAIT
+    assert chord.check([KIT_UP], True) == FAIL
+    assert chord.check([KIT_UP, KNOB_PRESS], False) == MATCH
+    assert chord.check([KIT_UP, release(KIT_UP)], False) == FAIL
+    assert chord.check([KIT_UP, TALL], False) == FAIL
+
+
+def test_double_tap_check():
+    double = DoubleTap('dbl', TALL, None, 0.1)
+    assert double.check([TALL], False) == WAIT
+    assert double.check([TALL, release(TALL)], False) == WAIT
+    assert double.check([TALL, release(TALL), TALL], False) == MATCH
+    assert double.check([TALL, release(TALL)], True) == FAIL
+    assert double.check([TALL, SHORT], False) == FAIL
+
+
+def test_long_press_check():
+    long = LongPress('lng', SHORT, None, 0.1)
+    assert long.check([SHORT], False) == WAIT
+    assert long.check([SHORT], True) == MATCH
+    assert long.check([SHORT, release(SHORT)], False) == FAIL
+
+
+@pytest.mark.parametrize('mode, expected', [
+    ('defer', [(Z, 1), (Z, 0)]),
+    ('speculate', [(UP, 1), (UP, 0), (Z, 1), (Z, 0)]),
+])
+def test_chord(make_rig, traced, mode, expected):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(KIT_UP, KNOB_PRESS)
+    rig.loop.advance(0.01)
+    rig.feed(release(KIT_UP), release(KNOB_PRESS))
+    assert rig.keys() == expected
+    assert rig.service.held == {}
+
+
+@pytest.mark.parametrize('mode', ['defer', 'speculate'])
+def test_chord_times_out(make_rig, traced, mode):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(KIT_UP)
+    rig.loop.advance(0.05)
+    rig.feed(KIT_UP)  # another press of a combo key restarts nothing
+    assert rig.service.combo.deadline == pytest.approx(0.1)
+    rig.loop.advance(0.049)
+    assert rig.service.combo.start is not None
+    rig.loop.advance(0.002)
+    assert rig.service.combo.start is None
+    rig.feed(release(KIT_UP))
+    assert rig.keys() == [(UP, 1), (UP, 0)]
+    assert isinstance(untraced(rig.service.table[KIT_UP]), ComboKey)
+
+
+@pytest.mark.parametrize('mode, expected', [
+    ('defer', [(ENTER, 1), (ENTER, 0)]),
+    ('speculate', [(SPACE, 1), (SPACE, 0), (ENTER, 1), (ENTER, 0)]),
+])
+def test_double_tap(make_rig, traced, mode, expected):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(TALL, release(TALL))
+    rig.loop.advance(0.03)
+    rig.feed(TALL)
+    rig.feed(release(TALL))
+    assert rig.keys() == expected
+
+
+@pytest.mark.parametrize('mode', ['defer', 'speculate'])
+def test_single_tap(make_rig, traced, mode):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(TALL, release(TALL))
+    rig.loop.advance(0.15)
+    assert rig.keys() == [(SPACE, 1), (SPACE, 0)]
+
+
+@pytest.mark.parametrize('mode, expected', [
+    ('defer', [(TAB, 1), (TAB, 0)]),
+    ('speculate', [(ESC, 1), (ESC, 0), (TAB, 1), (TAB, 0)]),
+])
+def test_long_press(make_rig, traced, mode, expected):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(SHORT)
+    rig.loop.advance(0.15)
+    rig.feed(release(SHORT))
+    assert rig.keys() == expected
+
+
+@pytest.mark.parametrize('mode', ['defer', 'speculate'])
+def test_short_press(make_rig, traced, mode):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(SHORT, release(SHORT))
+    rig.loop.advance(0.15)
+    assert rig.keys() == [(ESC, 1), (ESC, 0)]
+    assert rig.service.held == {}
+
+
+@pytest.mark.parametrize('mode', ['defer', 'speculate'])
+def test_other_button_ends_combo(make_rig, traced, mode):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(KIT_UP, TALL, release(TALL), release(KIT_UP))
+    rig.loop.advance(0.15)
+    assert rig.keys() == [(UP, 1), (SPACE, 1), (SPACE, 0), (UP, 0)]
+
+
+@pytest.mark.parametrize('mode', ['defer', 'speculate'])
+def test_reverse_turn_ends_combo(make_rig, traced, mode):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(KIT_UP)
+    rig.feed(KNOB_REVERSE)
+    rig.feed(release(KIT_UP))
+    assert rig.keys() == [(UP, 1), (MINUS, 1), (MINUS, 0), (UP, 0)]
+
+
+@pytest.mark.parametrize('mode', ['defer', 'speculate'])
+def test_unplug_drops_pending_combo(make_rig, traced, mode):
+    rig = make_rig(CONFIG.format(mode=mode))
+    rig.feed(KIT_UP)
+    rig.unplug()
+    rig.loop.advance(0.15)
+    assert rig.service.held == {}
+    keys = rig.keys()
+    assert keys.count((UP, 1)) == keys.count((UP, 0))
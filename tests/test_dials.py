@@ -0,0 +1,36 @@
+KNOB = 0x04
+EQUAL = 13
+
+CONFIG = '''
+name = "dials"
+[layouts.main.knob]
+turn = { action = "equal", reverse = "minus", rate = 3 }
+[shortcuts]
+[macros]
+[menus]
+'''
+
+
+def taps(make_rig, spacing, per_read, reads=8):
+    rig = make_rig(CONFIG)
+    rig.loop.advance(1)  # the first detent has nothing to be fast against
+    for _ in range(reads):
+        rig.loop.advance(spacing * per_read)
+        rig.feed(*[KNOB] * per_read)
+    return rig.keys().count((EQUAL, 1))
+
+
+def test_slow_turn_is_not_accelerated(make_rig):
+    assert taps(make_rig, 0.2, 1) == 8
+    assert taps(make_rig, 0.2, 4) == 32
+
+
+def test_fast_turn_is_accelerated(make_rig):
+    # the first detent has no pace yet
+    assert taps(make_rig, 0.01, 1) == 3 * 8 - 2
+
+
+def test_batching_does_not_change_speed(make_rig):
+    # the same pace read one detent at a time or four at a time
+    assert taps(make_rig, 0.2, 4) == taps(make_rig, 0.2, 1) * 4
+    assert taps(make_rig, 0.01, 4) >= taps(make_rig, 0.01, 1) * 4 - 4
@@ -0,0 +1,25 @@
+import os
+
+from tourboxneo.loop import Loop
+from tourboxneo.sources import GeneratorReader
+
+
+def test_generator_reader_delivers_large_chunks():
+    # bigger than the pipe buffer, so writes only take part of a chunk
+    chunks = [bytes([i]) * 50000 for i in range(4)]
+    got = bytearray()
+    with Loop() as loop, GeneratorReader([(0, c) for c in chunks], loop,
+                                         speed=0) as reader:
+        def read():
+            try:
+                bs = os.read(reader.fileno(), 65536)
+            except BlockingIOError:
+                return
+            if not bs:
+                loop.stop()
+            got.extend(bs)
+
+        loop.add_reader(reader.fileno(), read)
+        loop.run()
+    assert bytes(got) == b''.join(chunks)
+    assert reader.sent == len(got)
@@ -0,0 +1,28 @@
+from tourboxneo.writer import EVENT, Emitter, MemorySink
+
+KEY_A = EVENT.pack(0, 0, 1, 30, 1)
+
+
+class FlakySink:
+    def __init__(self, failures):
+        self.failures = failures
+        self.sent = []
+
+    def send(self, buf):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('device went away')
+        self.sent.append(bytes(buf))
+
+
+def test_failing_sink_drops_only_its_own_batch():
+    before, flaky, after = MemorySink(), FlakySink(1), MemorySink()
+    emitter = Emitter([before, flaky, after])
+    for _ in range(2):
+        emitter.emit(KEY_A)
+        emitter.syn()
+    assert before.writes == after.writes == 2
+    assert before.data == after.data
+    assert len(flaky.sent) == 1
+    assert emitter.dropped == 1
+    assert not emitter.pending
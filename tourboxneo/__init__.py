@@ -1,138 +1,473 @@
-from evdev import UInput, ecodes as e
-from evdev.device import KbdInfo
-from time import sleep
 import logging
-import toml
+from time import perf_counter
 
-from .actions import ActionNone
-from .reader import Reader
-from .controls import ButtonCtrl, DialCtrl, clobbers
+from .combos import ComboEngine
+from .dispatch import trace_table, tracing
+from .reader import Reader, RELEASE_MASK, REVERSE_MASK
+from .sinks import grow_sinks, open_sinks
+from .writer import Emitter
 
 VERSION = '0.3'
+RECONNECT_DELAY = 5
+HOTPLUG_RETRY = 0.1  # the node may not be openable the instant it appears
+HOTPLUG_RETRIES = 20
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
 
 class Service:
-    def __init__(self, config, device):
+    def __init__(self, config, device, loop, source=None, recorder=None):
         self.config = config
         self.device = device
+        # what the device symlink pointed at when we started, for when it's
+        # gone while unplugged
+        self.node = None if device is None else device.resolve()
+        self.loop = loop
+        self.source = source or (lambda: Reader(self.device, self.claimed()))
+        self.source_is_serial = source is None
+        self.recorder = recorder
+        self.metrics = None
+        self.hub = None  # set when several services share a loop
+        self.hotplug = None
+        self.reader = None
+        self.retry = None  # timer of the next input check
+        self.running = False
+        self.outputs = ('uinput', )  # sink specs, see sinks.open_sink
+        self.sinks = []
         self.writer = None
         self.layout = 'main'
+        self.layers = ()  # active layers, in stacking order
+        self.traced = {}  # id of a table -> its traced copy
+        self.table = None
+        self.activate()
         self.held = {} # currently held buttons, no dials
         self.counters = {}  # counters for dials
+        self.playing = {}  # macro -> its running playback
+        self.repeats = {}  # held key -> (when, timer) of its next repeat
+        self.combo = ComboEngine(self)
+        self.now = 0.0  # arrival time of the bytes being dispatched
+        self.batch = None  # and those bytes, when they came in one read
 
     def __enter__(self):
         logger.info('Starting TourBoxNEO Service')
-        self.connect_input()
-        self.connect_output()
+        self.running = True
+        if self.writer is None:
+            self.connect_output()
+        if self.source_is_serial and self.hub is None:
+            self.watch_hotplug()
+        self.check_input()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        # nothing may fire once we're gone, the loop can outlive us
+        self.running = False
+        if self.retry is not None:
+            self.retry.cancel()
+            self.retry = None
+        self.combo.cancel()
+        for playback in list(self.playing.values()):
+            playback.cancel()
+        if self.writer is not None:
+            try:
+                self.clobber(list(self.held))
+                self.writer.syn()
+            except OSError as err:
+                logger.warning('Could not release held buttons: %s', err)
         if self.reader is not None:
+            self.loop.remove_reader(self.reader.fileno())
             self.reader.__exit__(exc_type, exc_value, traceback)
+        self.disconnect_output()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.hotplug is not None and self.hub is None:
+            self.hotplug.close()
         logger.info('Halting TourBoxNEO Service')
 
     def connect_input(self):
-        reader = Reader(self.device)
+        reader = self.source()
         self.reader = reader.__enter__()
+        if self.metrics is None:
+            self.loop.add_reader(self.reader.fileno(), self.tick)
+        else:
+            self.metrics.count('connects')
+            self.loop.add_reader(self.reader.fileno(), self.tick_metered)
 
     def disconnect_input(self, exc_type, exc_value, traceback):
-        logger.warn('Input disconnected: %s', exc_value)
+        logger.warning('Input disconnected: %s', exc_value)
+        if self.metrics is not None:
+            self.metrics.count('disconnects')
+        # no release is coming for these anymore, repeats stop with them;
+        # a pending combo would otherwise play its presses back later
+        self.combo.cancel()
+        self.clobber(list(self.held))
+        self.writer.syn()
         if self.reader is not None:
+            self.loop.remove_reader(self.reader.fileno())
             self.reader.__exit__(exc_type, exc_value, traceback)
         self.reader = None
+        if self.hotplug is None:
+            self.check_later(RECONNECT_DELAY)
 
-    def check_input(self):
+    def check_later(self, delay, retries=0):
+        if self.retry is not None:
+            self.retry.cancel()
+        self.retry = self.loop.call_later(delay, self.check_input, retries)
+
+    def check_input(self, retries=0):
+        self.retry = None
+        if not self.running:
+            return False
         if self.reader is None:
             try:
                 self.connect_input()
-            except:
-                sleep(5)
+            except (RuntimeError, OSError) as err:
+                logger.info('No input yet: %s', err)
+                if self.hotplug is None:
+                    self.check_later(RECONNECT_DELAY)
+                elif retries > 0:
+                    self.check_later(HOTPLUG_RETRY, retries - 1)
         return self.reader is not None
 
-    def connect_output(self):
-        self.writer = UInput(
-            {
-                e.EV_KEY: e.keys.keys(),
-                e.EV_REL: [e.REL_WHEEL, e.REL_HWHEEL],
-            },
-            name='TourBoxNEO',
-            vendor=0x0483,
-            product=0x5740)
-
-    def clobber(self, btn):
-        cbs = clobbers[btn.group].get(btn.key, None)
-        if cbs is None:
+    def watch_hotplug(self):
+        from .hotplug import Hotplug
+        try:
+            self.hotplug = Hotplug(self.loop, self.plugged)
+        except OSError as err:
+            logger.warning('No hotplug events, polling instead: %s', err)
+
+    def plugged(self, dev_path):
+        if self.device is not None and not self.owns(dev_path):
             return
-        for c in cbs:
-            self.release(c)
+        self.check_input(HOTPLUG_RETRIES)
+
+    def owns(self, dev_path):
+        # -d is usually a stable symlink like /dev/serial/by-id/..., while
+        # hotplug reports the tty node itself
+        if self.device.exists():
+            self.node = self.device.resolve()
+        return self.node == dev_path.resolve()
+
+    def claimed(self):
+        if self.hub is None:
+            return ()
+        return self.hub.claimed()
+
+    def connect_output(self):
+        self.sinks = open_sinks(self.loop, self.outputs, self.config.codes)
+        self.writer = Emitter(self.sinks)
+
+    def grow_output(self, codes):
+        self.sinks = grow_sinks(self.loop, self.outputs, self.sinks, codes)
+        self.writer.sinks = tuple(self.sinks)
+
+    def disconnect_output(self):
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+        self.writer = None
+
+    def hold(self, key, handler):
+        # False when the key is already held, the press is then dropped
+        if key in self.held:
+            logger.warning('Double hold of b%s, dropping the press', hex(key))
+            if self.metrics is not None:
+                self.metrics.count('double_holds')
+            return False
+        self.held[key] = handler
+        return True
+
+    def unhold(self, key):
+        handler = self.held.pop(key, None)
+        if handler is not None:
+            handler.release(self)
+
+    def clobber(self, keys):
+        for key in keys:
+            self.unhold(key)
+
+    def detents(self, key, ctrl):
+        if ctrl.rate == 1:
+            return 1
+        # speed is measured per read: every detent in it came in since the
+        # previous read that had any, so they share that time equally. One
+        # timestamp per read would make all but the first look instant.
+        counter = self.counters.get(key, None)
+        if counter is None:
+            # time of the last read, seconds per detent in it, fraction
+            counter = self.counters[key] = [0.0, 0.0, 0.0]
+        if counter[0] != self.now:
+            n = 1 if self.batch is None else max(self.batch.count(key), 1)
+            counter[1] = (self.now - counter[0]) / n
+            counter[0] = self.now
+        counter[2] += ctrl.gain(counter[1])
+        count = int(counter[2])
+        counter[2] -= count
+        return count
+
+    def dispatch(self, b):
+        self.now = self.loop.time()
+        self.batch = None
+        handler = self.table[b]
+        if handler is not None:
+            handler(self)
 
     def press(self, btn, reverse):
-        layout = self.config.layouts[self.layout]
-        cmd = layout.controls[btn.group][btn.key]
-        if cmd is None or isinstance(cmd, ActionNone):
-            return
-        logger.debug('Command found: %s', cmd)
-
-        self.clobber(btn)
-
-        if isinstance(cmd, ButtonCtrl):
-            if (btn.group, btn.key) in self.held:
-                raise Error('Double hold')
-            if cmd.kind == 'hold':
-                self.held[(btn.group, btn.key)] = cmd
-                cmd.action.press(self.writer)
-                logger.debug('Hold starts: %s', cmd.action)
-            elif cmd.kind == 'up':
-                self.held[(btn.group, btn.key)] = cmd
-            elif cmd.kind == 'down':
-                cmd.action.press(self.writer)
-                cmd.action.release(self.writer)
-                logger.debug('Down triggers: %s', cmd.action)
-        elif isinstance(cmd, DialCtrl):
-            action = cmd.action if not reverse else cmd.reverse
-            action.press(self.writer)
-            action.release(self.writer)
-            logger.debug('Dial moves: %s', action)
-        else:
-            raise Error('Invalid command')
+        self.dispatch(btn.byte | REVERSE_MASK if reverse else btn.byte)
 
     def release(self, btn):
-        cmd = self.held.pop((btn.group, btn.key), None)
-        if cmd is None:
+        self.dispatch(btn.byte | RELEASE_MASK)
+
+    def swap_config(self, config):
+        # held buttons keep the handlers they were pressed with, so they
+        # release against the bindings they were pressed under
+        if self.layout not in config.layouts:
+            logger.warning('Layout %s is gone, back to main', self.layout)
+            self.layout = 'main'
+        self.config = config
+        self.traced.clear()
+        self.combo.captures.clear()
+        self.layers = config.stack(l for l in self.layers
+                                   if l in config.layouts)
+        self.activate()
+        if self.sinks:
+            self.grow_output(config.codes)
+        logger.info('Config reloaded: %s', config.name)
+
+    def activate(self):
+        # every stack is merged ahead of time, switching is one assignment
+        table = self.config.resolve(self.layout, self.layers)
+        if tracing():
+            traced = self.traced.get(id(table), None)
+            if traced is None:
+                traced = self.traced[id(table)] = trace_table(table)
+            table = traced
+        self.table = table
+
+    def set_layout(self, name):
+        self.layout = name
+        self.activate()
+        logger.info('Layout: %s', name)
+
+    def focus(self, wm_class, since):
+        apps = self.config.apps
+        layout = apps.get(wm_class.lower(), None) or apps.get('*', None)
+        if layout is None or layout == self.layout:
             return
-        if not isinstance(cmd, ButtonCtrl):
-            raise Error('Releasing non-button')
-        if cmd.kind == 'hold':
-            cmd.action.release(self.writer)
-            logger.debug('Hold ends: %s', cmd.action)
-        elif cmd.kind == 'up':
-            cmd.action.press(self.writer)
-            cmd.action.release(self.writer)
-            logger.debug('Up triggers: %s', cmd.action)
-        elif cmd.kind == 'down':
-            raise Error('Releasing down button')
+        self.set_layout(layout)
+        logger.info('Focus on %s switched layout in %.0fus', wm_class,
+                    (self.loop.time() - since) * 1e6)
 
+    def layer_on(self, name):
+        if name not in self.layers:
+            self.layers = self.config.stack(self.layers + (name, ))
+            self.activate()
+            logger.debug('Layers: %s', self.layers)
 
-    def tick(self):
-        if not self.check_input():
+    def layer_off(self, name):
+        if name in self.layers:
+            self.layers = tuple(l for l in self.layers if l != name)
+            self.activate()
+            logger.debug('Layers: %s', self.layers)
+
+    def layer_toggle(self, name):
+        if name in self.layers:
+            self.layer_off(name)
+        else:
+            self.layer_on(name)
+
+    def pick(self, entry):
+        # a menu entry names either a layout or a library action
+        name = entry['action']
+        if name in self.config.layouts:
+            self.set_layout(name)
+            return
+        try:
+            action = self.config.library.lookup(name)
+        except KeyError:
+            logger.error('Unknown menu action: %s', name)
             return
+        action.tap(self)
+        self.writer.syn()
 
+    def run(self):
+        self.loop.run()
+
+    def tick(self):
         try:
-            data = self.reader.tick()
+            bs = self.reader.read()
         except RuntimeError as err:
             self.disconnect_input(RuntimeError, err, None)
             return
+        if self.recorder is not None:
+            self.recorder.record(bs)
 
-        if not data:
+        self.now = self.loop.time()
+        self.batch = bs
+        for b in bs:
+            # not hoisted: a layer button earlier in the batch may swap it
+            handler = self.table[b]
+            if handler is not None:
+                handler(self)
+
+        self.writer.syn()
+
+    def tick_metered(self):
+        # tick, with every stage timed; only used when metrics are on
+        metrics = self.metrics
+        started = self.loop.time()
+        start = perf_counter()
+        try:
+            bs = self.reader.read()
+        except RuntimeError as err:
+            self.disconnect_input(RuntimeError, err, None)
             return
-        btn, release, reverse = data
+        read = perf_counter()
+        metrics.read.observe(read - start)
+        metrics.count('batches')
+        metrics.count('bytes', len(bs))
+        if self.recorder is not None:
+            self.recorder.record(bs)
 
-        if not release:
-            self.press(btn, reverse)
-        else:
-            self.release(btn)
+        self.now = self.loop.time()
+        self.batch = bs
+        for b in bs:
+            handler = self.table[b]
+            if handler is not None:
+                handler(self)
+        dispatched = perf_counter()
+        metrics.dispatch.observe(dispatched - read)
 
+        dropped = self.writer.dropped
         self.writer.syn()
+        if self.writer.dropped != dropped:
+            metrics.count('dropped_reports', self.writer.dropped - dropped)
+        metrics.emit.observe(perf_counter() - dispatched)
+        # asyncio's loop doesn't say when it woke up, the read will do
+        polled = getattr(self.loop, 'polled', None) or started
+        metrics.latency.observe(self.loop.time() - polled)
+
+
+# Runs several services, one per TourBox, on one loop. Each keeps its own
+# layout, held buttons and config; output is one shared set of sinks unless
+# shared_output is off, and one hotplug watcher serves them all.
+class Hub:
+    def __init__(self, loop, shared_output=True, outputs=('uinput', )):
+        self.loop = loop
+        self.shared_output = shared_output
+        self.outputs = tuple(outputs)
+        self.services = []
+        self.sinks = []
+        self.writer = None
+        self.hotplug = None
+        self.watchers = []
+        self.focus_source = None
+        self.exporter = None
+
+    def add(self, config, device, source=None, recorder=None):
+        service = Service(config, device, self.loop, source, recorder)
+        service.hub = self
+        service.outputs = self.outputs
+        self.services.append(service)
+        return service
+
+    def __enter__(self):
+        logger.info('Starting TourBoxNEO Hub with %d devices',
+                    len(self.services))
+        if self.shared_output:
+            self.sinks = open_sinks(self.loop, self.outputs, self.codes())
+            self.writer = Emitter(self.sinks)
+        elif len(self.services) > 1 and any(
+                spec.startswith('unix:') for spec in self.outputs):
+            raise RuntimeError('Socket outputs need shared output')
+        if any(s.source_is_serial for s in self.services):
+            from .hotplug import Hotplug
+            try:
+                self.hotplug = Hotplug(self.loop, self.plugged)
+            except OSError as err:
+                logger.warning('No hotplug events, polling instead: %s', err)
+        # services with an explicit device claim theirs before any other
+        # service goes looking for a free one
+        services = sorted(self.services, key=lambda s: s.device is None)
+        for service in services:
+            service.writer = self.writer
+            service.hotplug = self.hotplug
+            service.__enter__()
+        return self
+
+    def watch_configs(self, cache=True):
+        from .watch import ConfigWatcher
+        paths = {s.config.path for s in self.services} - {None}
+        for path in paths:
+            try:
+                self.watchers.append(
+                    ConfigWatcher(self.loop, path, self.reload, cache))
+            except OSError as err:
+                logger.warning('Not watching %s: %s', path, err)
+
+    def export_metrics(self, spec):
+        # before __enter__, services pick their tick when they connect
+        from .metrics import Metrics, open_exporter
+        metrics = Metrics()
+        self.exporter = open_exporter(self.loop, metrics, spec)
+        for service in self.services:
+            service.metrics = metrics
+
+    def follow_focus(self, spec):
+        from .focus import open_focus
+        try:
+            self.focus_source = open_focus(self.loop, spec, self.focus)
+        except Exception as err:
+            logger.error('Not following window focus: %s', err)
+
+    def focus(self, wm_class, since):
+        for service in self.services:
+            service.focus(wm_class, since)
+
+    def reload(self, path, config):
+        for service in self.services:
+            if service.config.path == path:
+                service.swap_config(config)
+        if self.sinks:
+            self.sinks = grow_sinks(self.loop, self.outputs, self.sinks,
+                                    self.codes())
+            self.writer.sinks = tuple(self.sinks)
+
+    def codes(self):
+        # a shared device serves every config
+        return frozenset().union(*(s.config.codes for s in self.services))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for service in self.services:
+            service.__exit__(exc_type, exc_value, traceback)
+        for watcher in self.watchers:
+            watcher.close()
+        if self.focus_source is not None:
+            self.focus_source.close()
+        if self.exporter is not None:
+            self.exporter.close()
+        if self.hotplug is not None:
+            self.hotplug.close()
+        for sink in self.sinks:
+            sink.close()
+        logger.info('Halting TourBoxNEO Hub')
+
+    def claimed(self):
+        # resolved, a service given a symlink holds the tty behind it
+        return {s.reader.dev_path.resolve() for s in self.services
+                if s.reader is not None and hasattr(s.reader, 'dev_path')}
+
+    def plugged(self, dev_path):
+        for service in self.services:
+            if (service.reader is None and service.device is not None
+                    and service.owns(dev_path)):
+                service.check_input(HOTPLUG_RETRIES)
+                return
+        for service in self.services:
+            if (service.reader is None and service.device is None
+                    and service.source_is_serial):
+                service.check_input(HOTPLUG_RETRIES)
+                return
+
+    def run(self):
+        self.loop.run()
@@ -1,29 +1,42 @@
 import argparse
 import logging
+import logging.handlers
 import signal
 import os
 from pathlib import Path
+from queue import SimpleQueue
 
 from .config import Config
-from . import Service
+from .loop import Loop
+from .sources import PtyReader, ReplayReader, Recorder
+from . import Hub
 
 logger = logging.getLogger('tourboxneo')
 
 
-class GracefulKiller:
-    exiting = False
+def device_binding(arg):
+    # by-path device names have colons of their own, so the tail is only a
+    # config when it names a file
+    device, colon, config_path = arg.rpartition(':')
+    if colon and Path(config_path).is_file():
+        return Path(device), Path(config_path)
+    if colon and config_path.endswith('.toml') and not Path(arg).exists():
+        raise argparse.ArgumentTypeError(f'no config file {config_path}')
+    return Path(arg), None
 
-    def __init__(self):
-        signal.signal(signal.SIGINT, self.exit_gracefully)
-        signal.signal(signal.SIGTERM, self.exit_gracefully)
 
-    def exit_gracefully(self, *args):
-        self.exiting = True
+def log_through_queue():
+    # records are handed to a listener thread, so a slow stderr or journald
+    # never holds up the event loop
+    root = logging.getLogger()
+    listener = logging.handlers.QueueListener(SimpleQueue(), *root.handlers,
+                                              respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(listener.queue)]
+    listener.start()
+    return listener
 
 
 def main():
-    killer = GracefulKiller()
-
     parser = argparse.ArgumentParser(prog='tourboxneo',
                                      description='TourBox NEO Service')
     parser.add_argument('-c',
@@ -32,8 +45,45 @@ def main():
                         help='TOML-formatted definitions file')
     parser.add_argument('-d',
                         '--device',
-                        type=Path,
-                        help='device file')
+                        type=device_binding,
+                        action='append',
+                        default=[],
+                        metavar='DEVICE[:CONFIG]',
+                        help='device file, optionally with its own config; '
+                        'may be given once per device')
+    parser.add_argument('-n',
+                        '--devices',
+                        type=int,
+                        default=1,
+                        help='number of devices to serve, devices not given '
+                        'with -d are detected')
+    parser.add_argument('--output',
+                        choices=['shared', 'per-device'],
+                        default='shared',
+                        help='one uinput device for all TourBoxes or one each')
+    parser.add_argument('--sink',
+                        action='append',
+                        metavar='OUTPUT',
+                        help='where events go: uinput (default), raw for '
+                        'uinput without evdev, or unix:SOCKET_PATH to stream '
+                        'them; may be given several times')
+    parser.add_argument('--no-reload',
+                        action='store_true',
+                        help='don\'t reload config files when they change')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='always parse config files, skip the compiled cache')
+    parser.add_argument('--focus',
+                        metavar='SOURCE',
+                        help='switch layouts per [apps] as window focus '
+                        'changes, SOURCE is x11 or unix:SOCKET_PATH')
+    parser.add_argument('--metrics',
+                        metavar='TARGET',
+                        help='time every stage and export the results, TARGET '
+                        'is unix:SOCKET_PATH or file:PROMETHEUS_TEXT_FILE')
+    parser.add_argument('--log-queue',
+                        action='store_true',
+                        help='write log output from a separate thread')
     parser.add_argument('-p',
                         '--pidfile',
                         type=str,
@@ -41,21 +91,82 @@ def main():
                         help='pid file')
     parser.add_argument('-D', '--daemon', default=False)
     parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--record',
+                        type=Path,
+                        help='write the raw input bytes to a capture file')
+    parser.add_argument('--replay',
+                        type=Path,
+                        help='read input from a capture file instead')
+    parser.add_argument('--speed',
+                        type=float,
+                        default=1,
+                        help='replay speed factor, 0 for as fast as possible')
+    parser.add_argument('--pty',
+                        action='store_true',
+                        help='read input from a new pseudo terminal')
+    parser.add_argument('--startup-profile',
+                        action='store_true',
+                        help='report import and config parse times, then exit')
 
     args = parser.parse_args()
 
     logger.setLevel(30 - (min(args.verbose, 2) * 10))
+    listener = log_through_queue() if args.log_queue else None
+    try:
+        run(args)
+    finally:
+        if listener is not None:
+            listener.stop()
+
+
+def run(args):
+    if args.startup_profile:
+        from .startup import report
+        report(args.config, cache=not args.no_cache)
+        return
 
-    config = Config.from_file(args.config)
+    config = Config.from_file(args.config, cache=not args.no_cache)
 
     # pid file
     if args.daemon:
         p = Path(args.pidfile)
         p.write_text(str(os.getpid()))
 
-    with Service(config, args.device) as service:
-        while not killer.exiting:
-            service.tick()
+    with Loop() as loop:
+        loop.add_signal_handler(signal.SIGINT, loop.stop)
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        source = None
+        if args.replay is not None:
+            source = lambda: ReplayReader(args.replay, loop, args.speed,
+                                          done=loop.stop)
+        elif args.pty:
+            source = PtyReader
+        recorder = Recorder(args.record) if args.record else None
+
+        hub = Hub(loop, shared_output=args.output == 'shared',
+                  outputs=args.sink or ('uinput', ))
+        if source is not None:
+            hub.add(config, None, source, recorder)
+        else:
+            configs = {None: config}
+            for device, config_path in args.device:
+                if config_path not in configs:
+                    configs[config_path] = Config.from_file(
+                        config_path, cache=not args.no_cache)
+                hub.add(configs[config_path], device, recorder=recorder)
+                recorder = None  # only the first device is recorded
+            for _ in range(args.devices - len(args.device)):
+                hub.add(config, None, recorder=recorder)
+                recorder = None
+
+        if args.metrics:
+            hub.export_metrics(args.metrics)
+        with hub:
+            if not args.no_reload:
+                hub.watch_configs(cache=not args.no_cache)
+            if args.focus:
+                hub.follow_focus(args.focus)
+            hub.run()
 
 
 if __name__ == '__main__':
@@ -1,83 +1,136 @@
 from evdev import ecodes as e
-from copy import copy
 import logging
 import re
 
-from .menu import Menu, gui_thread
+from .writer import encode, encode_report
 
 logger = logging.getLogger(__name__)
 
+SHIFT = 0x1
+CTRL = 0x2
+ALT = 0x4
+CMD = 0x8
+
+MOD_KEYS = (
+    (SHIFT, e.KEY_LEFTSHIFT, 'S'),
+    (CTRL, e.KEY_LEFTCTRL, 'C'),
+    (ALT, e.KEY_LEFTALT, 'A'),
+    (CMD, e.KEY_LEFTMETA, 'D'),
+)
+
+
+def mod_mask(shift=False, ctrl=False, alt=False, cmd=False):
+    return ((SHIFT if shift else 0) | (CTRL if ctrl else 0) |
+            (ALT if alt else 0) | (CMD if cmd else 0))
+
+
+class Frozen:
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def set(self, **fields):
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        # pickle's own slot restore goes through __setattr__, which refuses
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return thaw, (type(self), state)
+
+
+def thaw(cls, state):
+    obj = cls.__new__(cls)
+    obj.set(**state)
+    return obj
+
+
+class Action(Frozen):
+    __slots__ = ('name', )
+    fields = ('name', )
 
-class Action:
     def __init__(self, name):
-        self.name = name
+        self.set(name=name)
+
+    def replace(self, **changes):
+        args = {f: changes.get(f, getattr(self, f)) for f in self.fields}
+        return type(self)(**args)
 
     def with_name(self, name):
-        new = copy(self)
-        new.name = name
-        return new
+        return self.replace(name=name)
 
-    def press(self, writer):
+    def codes(self):
+        # (event type, code) pairs the output device has to support
+        return ()
+
+    def press(self, service):
         pass
 
-    def release(self, writer):
+    def release(self, service):
         pass
 
+    def tap(self, service, count=1):
+        for _ in range(count):
+            self.press(service)
+            self.release(service)
+
     def __repr__(self):
         return f'Action(name={self.name})'
 
 
 class ActionNone(Action):
-    pass
+    __slots__ = ()
 
 
 class ActionMod(Action):
-    def __init__(self, name, shift=False, ctrl=False, alt=False, cmd=False):
+    __slots__ = ('mods', 'on_press', 'on_release')
+    fields = ('name', 'mods')
+
+    def __init__(self, name, mods=0, **flags):
         super().__init__(name)
-        self.shift = shift
-        self.ctrl = ctrl
-        self.alt = alt
-        self.cmd = cmd
-
-    def with_mods(self, shift=False, ctrl=False, alt=False, cmd=False):
-        new = copy(self)
-        new.shift = self.shift or shift
-        new.ctrl = self.ctrl or ctrl
-        new.alt = self.alt or alt
-        new.cmd = self.cmd or cmd
-        return new
-
-    def press(self, writer):
-        if self.shift:
-            writer.write(e.EV_KEY, e.KEY_LEFTSHIFT, 1)
-        if self.ctrl:
-            writer.write(e.EV_KEY, e.KEY_LEFTCTRL, 1)
-        if self.alt:
-            writer.write(e.EV_KEY, e.KEY_LEFTALT, 1)
-        if self.cmd:
-            writer.write(e.EV_KEY, e.KEY_LEFTMETA, 1)
-
-    def release(self, writer):
-        if self.shift:
-            writer.write(e.EV_KEY, e.KEY_LEFTSHIFT, 0)
-        if self.ctrl:
-            writer.write(e.EV_KEY, e.KEY_LEFTCTRL, 0)
-        if self.alt:
-            writer.write(e.EV_KEY, e.KEY_LEFTALT, 0)
-        if self.cmd:
-            writer.write(e.EV_KEY, e.KEY_LEFTMETA, 0)
+        self.set(mods=mods | mod_mask(**flags))
+        self.encode()
+
+    def with_mods(self, **flags):
+        mods = self.mods | mod_mask(**flags)
+        if mods == self.mods:
+            return self
+        return self.replace(mods=mods)
+
+    def encode(self):
+        # whole press and release reports, emitted with a single buffer append
+        self.set(on_press=encode_report(self.press_events()),
+                 on_release=encode_report(self.release_events()))
+
+    def codes(self):
+        return {(t, c) for t, c, _ in self.press_events()}
+
+    def mod_events(self, value):
+        return [(e.EV_KEY, key, value)
+                for mask, key, _ in MOD_KEYS if self.mods & mask]
+
+    def press_events(self):
+        return self.mod_events(1)
+
+    def release_events(self):
+        return self.mod_events(0)
+
+    def press(self, service):
+        service.writer.emit(self.on_press)
+
+    def release(self, service):
+        service.writer.emit(self.on_release)
 
     def __repr_mods__(self):
-        mods = ''
-        if self.shift:
-            mods += 'S'
-        if self.ctrl:
-            mods += 'C'
-        if self.alt:
-            mods += 'A'
-        if self.cmd:
-            mods += 'D'
-        return mods
+        return ''.join(c for mask, _, c in MOD_KEYS if self.mods & mask)
 
     def __repr__(self):
         mods = self.__repr_mods__()
@@ -85,81 +138,199 @@ class ActionMod(Action):
 
 
 class ActionKey(ActionMod):
-    def __init__(self, name, key, **mods):
-        super().__init__(name, **mods)
-        self.key = key
+    __slots__ = ('key', )
+    fields = ('name', 'key', 'mods')
 
-    def press(self, writer):
-        super().press(writer)
-        writer.write(e.EV_KEY, self.key, 1)
+    def __init__(self, name, key, mods=0, **flags):
+        self.set(key=key)
+        super().__init__(name, mods, **flags)
 
-    def release(self, writer):
-        super().release(writer)
-        writer.write(e.EV_KEY, self.key, 0)
+    def press_events(self):
+        return super().press_events() + [(e.EV_KEY, self.key, 1)]
+
+    def release_events(self):
+        return super().release_events() + [(e.EV_KEY, self.key, 0)]
 
     def __repr__(self):
         mods = self.__repr_mods__()
         return f'ActionKey(name={self.name}, mods={mods}, key={self.key})'
 
 
+HIRES = {
+    e.REL_WHEEL: e.REL_WHEEL_HI_RES,
+    e.REL_HWHEEL: e.REL_HWHEEL_HI_RES,
+}
+
+
 class ActionRel(ActionMod):
-    def __init__(self, name, rel, step, **mods):
-        super().__init__(name, **mods)
-        self.rel = rel
-        self.step = step
+    __slots__ = ('rel', 'step', 'mods_down', 'mods_up')
+    fields = ('name', 'rel', 'step', 'mods')
 
-    def press(self, writer):
-        super().press(writer)
-        writer.write(e.EV_REL, self.rel, self.step)
+    def __init__(self, name, rel, step, mods=0, **flags):
+        self.set(rel=rel, step=step)
+        super().__init__(name, mods, **flags)
 
-    def release(self, writer):
-        super().release(writer)
-        writer.write(e.EV_REL, self.rel, 0)
+    def encode(self):
+        super().encode()
+        self.set(mods_down=encode(self.mod_events(1)),
+                 mods_up=encode_report(self.mod_events(0)))
+
+    def codes(self):
+        return {(t, c) for t, c, _ in self.mod_events(1)} | {
+            (e.EV_REL, self.rel), (e.EV_REL, HIRES[self.rel])}
+
+    def with_step(self, step):
+        return self.replace(step=step if self.step > 0 else -step)
+
+    def report(self, hires, detents):
+        # hires is in 1/120ths of a detent, the unit of the *_HI_RES axes
+        events = [(e.EV_REL, HIRES[self.rel], hires)]
+        if detents:
+            events.append((e.EV_REL, self.rel, detents))
+        return self.mods_down + encode_report(events) + self.mods_up
+
+    def press(self, service):
+        service.writer.scroll(self, 1)
+
+    def release(self, service):
+        pass
+
+    def tap(self, service, count=1):
+        # consecutive detents are merged into one event by the writer
+        service.writer.scroll(self, count)
 
     def reverse(self):
-        a = copy(self)
-        a.step = -self.step
-        return a
+        return self.replace(step=-self.step)
 
     def __repr__(self):
         mods = self.__repr_mods__()
-        return f'ActionKey(name={self.name}, mods={mods}, rel={self.rel}, step={self.step})'
+        return f'ActionRel(name={self.name}, mods={mods}, rel={self.rel}, step={self.step})'
 
 
 class ActionMacro(Action):
-    def __init__(self, name, actions):
+    __slots__ = ('steps', 'repeat')
+    fields = ('name', 'steps', 'repeat')
+
+    def __init__(self, name, steps, repeat=1):
+        # steps are (actions, delay) pairs: the actions of a step go out in
+        # one write, then playback waits `delay` seconds on a loop timer
         super().__init__(name)
-        self.actions = actions
+        self.set(steps=tuple((tuple(a), d) for a, d in steps), repeat=repeat)
+
+    def press(self, service):
+        # pressing the trigger again while it plays stops it
+        playback = service.playing.get(self, None)
+        if playback is not None:
+            playback.cancel()
+            logger.debug('Macro cancelled: %s', self.name)
+        elif self.steps:
+            Playback(service, self).step(syn=False)
 
-    def press(self, writer):
-        super().press(writer)
-        for action in self.actions:
-            action.press(writer)
-            action.release(writer)
+    def tap(self, service, count=1):
+        self.press(service)
 
-    def release(self, writer):
-        super().release(writer)
+    def codes(self):
+        return {code for actions, _ in self.steps
+                for action in actions for code in action.codes()}
 
     def __repr__(self):
-        return f'ActionMacro(name={self.name})'
+        return f'ActionMacro(name={self.name}, steps={len(self.steps)}, repeat={self.repeat})'
+
+
+class Playback:
+    __slots__ = ('service', 'macro', 'index', 'round', 'timer')
+
+    def __init__(self, service, macro):
+        self.service = service
+        self.macro = macro
+        self.index = 0
+        self.round = 0
+        self.timer = None
+        service.playing[macro] = self
+
+    def step(self, syn=True):
+        self.timer = None
+        service = self.service
+        actions, delay = self.macro.steps[self.index]
+        for action in actions:
+            action.tap(service)
+        if syn:
+            # the first step shares the write of the batch that triggered it
+            service.writer.syn()
+
+        self.index += 1
+        if self.index == len(self.macro.steps):
+            self.index = 0
+            self.round += 1
+            if self.round == self.macro.repeat:
+                self.finish()
+                return
+        self.timer = service.loop.call_later(delay, self.step)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.finish()
+
+    def finish(self):
+        if self.service.playing.get(self.macro, None) is self:
+            del self.service.playing[self.macro]
 
 
 class ActionMenu(Action):
+    __slots__ = ('entries', )
+    fields = ('name', 'entries')
+
     def __init__(self, name, entries):
         super().__init__(name)
-        self.entries = entries
+        self.set(entries=tuple(entries))
+
+    def press(self, service):
+        # Tk is only worth loading once a menu is actually shown
+        from .menu import show_menu
 
-    def press(self, writer):
-        super().press(writer)
-        start_tk(Menu())
+        def picked(entry):
+            service.loop.call_soon_threadsafe(service.pick, entry)
 
-    def release(self, writer):
-        super().release(writer)
+        show_menu(self.name, self.entries, picked)
 
     def __repr__(self):
         return f'ActionMenu(name={self.name})'
 
 
+class ActionLayout(Action):
+    __slots__ = ('layout', )
+    fields = ('name', 'layout')
+
+    def __init__(self, name, layout):
+        super().__init__(name)
+        self.set(layout=layout)
+
+    def press(self, service):
+        service.set_layout(self.layout)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(name={self.name}, layout={self.layout})'
+
+
+# active while held, stacked over the current layout
+class ActionLayer(ActionLayout):
+    __slots__ = ()
+
+    def press(self, service):
+        service.layer_on(self.layout)
+
+    def release(self, service):
+        service.layer_off(self.layout)
+
+
+class ActionToggle(ActionLayout):
+    __slots__ = ()
+
+    def press(self, service):
+        service.layer_toggle(self.layout)
+
+
 split_mod_re = re.compile('^([SCMAD])-')
 
 
@@ -186,20 +357,48 @@ def split_reverse(cmd_str):
     return rev, cmd_str
 
 
+TEXT_KEYS = {' ': 'space', '\t': 'tab', '\n': 'enter'}
+
+
 class Library:
     def __init__(self):
         self.cmds = {}
+        self.variants = {}  # (name, mod mask, reverse) -> interned action
         library_defaults(self)
 
     def lookup(self, cmd_str):
         mods, cmd_str = split_mods(cmd_str)
         rev, cmd_str = split_reverse(cmd_str)
         cmd = self.cmds[cmd_str]
-        if isinstance(cmd, ActionMod) and mods:
-            cmd = cmd.with_mods(**mods)
-        if isinstance(cmd, ActionRel) and rev:
-            cmd = cmd.reverse()
-        return cmd
+        mask = mod_mask(**mods) if mods else 0
+        if not (mask and isinstance(cmd, ActionMod)):
+            mask = 0
+        if not (rev and isinstance(cmd, ActionRel)):
+            rev = False
+        if not (mask or rev):
+            return cmd
+
+        key = (cmd_str, mask, rev)
+        variant = self.variants.get(key, None)
+        if variant is None:
+            variant = cmd.with_mods(**mods) if mask else cmd
+            if rev:
+                variant = variant.reverse()
+            self.variants[key] = variant
+        return variant
+
+    def text(self, text):
+        # one tap per character, shifted letters for capitals
+        actions = []
+        for c in text:
+            name = TEXT_KEYS.get(c, c)
+            cmd = self.cmds.get(name, None)
+            if cmd is None and name.lower() in self.cmds:
+                cmd = self.cmds[name.lower()].with_mods(shift=True)
+            if cmd is None:
+                raise RuntimeError(f'no key for {c!r}')
+            actions.append(cmd)
+        return actions
 
     def push(self, cmd):
         if cmd.name in self.cmds:
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+from . import Service
+from .reader import decode
+
+logger = logging.getLogger(__name__)
+
+
+# Runs a Service on an asyncio loop: Loop mirrors the asyncio methods the
+# service uses (add_reader, call_later, call_soon_threadsafe, ...), so the
+# device fd, timers and hotplug socket all sit in the caller's loop with no
+# thread of our own. Output still goes through the compiled layout tables;
+# on top of that, decoded events are offered to async iterators and hooks.
+#
+#     async with AsyncService(config) as service:
+#         service.on_press(notify)
+#         async for btn, release, reverse in service.events():
+#             ...
+class AsyncService(Service):
+    def __init__(self, config, device=None, loop=None, source=None,
+                 writer=None):
+        loop = loop or asyncio.get_running_loop()
+        super().__init__(config, device, loop, source)
+        read_from = self.source
+        self.source = lambda: Tap(read_from(), self)
+        self.writer = writer
+        self.press_hooks = []
+        self.release_hooks = []
+        self.queues = set()
+        self.tasks = set()
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            self.__exit__(exc_type, exc_value, traceback)
+        finally:
+            for queue in self.queues:
+                # a listener that fell behind loses its oldest event to
+                # make room for the end
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def on_press(self, hook):
+        # hook(btn, reverse) is a coroutine function
+        self.press_hooks.append(hook)
+        return hook
+
+    def on_release(self, hook):
+        self.release_hooks.append(hook)
+        return hook
+
+    async def events(self, maxsize=256):
+        queue = asyncio.Queue(maxsize)
+        self.queues.add(queue)
+        try:
+            while (event := await queue.get()) is not None:
+                yield event
+        finally:
+            self.queues.discard(queue)
+
+    def publish(self, bs):
+        if not (self.queues or self.press_hooks or self.release_hooks):
+            return
+        for event in decode(bs):
+            btn, release, reverse = event
+            for queue in self.queues:
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    logger.warning('Event listener too slow, dropping %s',
+                                   btn)
+            for hook in self.release_hooks if release else self.press_hooks:
+                task = self.loop.create_task(hook(btn, reverse))
+                self.tasks.add(task)
+                task.add_done_callback(self.hook_done)
+
+    def hook_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Hook failed: %r', task.exception())
+
+
+# Wraps a reader so every batch the service reads is also published.
+class Tap:
+    def __init__(self, reader, service):
+        self.reader = reader
+        self.service = service
+
+    def __enter__(self):
+        self.reader = self.reader.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.reader.__exit__(exc_type, exc_value, traceback)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def read(self):
+        bs = self.reader.read()
+        self.service.publish(bs)
+        return bs
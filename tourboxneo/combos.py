@@ -0,0 +1,300 @@
+import logging
+
+from .reader import RELEASE_MASK, REVERSE_MASK
+
+logger = logging.getLogger(__name__)
+
+CHORD_WINDOW = 0.05
+DOUBLE_WINDOW = 0.25
+LONG_WINDOW = 0.5
+
+MODES = ('defer', 'speculate')
+
+WAIT = 0
+MATCH = 1
+FAIL = 2
+
+
+# Chords, double taps and long presses the firmware doesn't report itself.
+# Their buttons get a ComboKey in the layout table. Once one is pressed the
+# service runs on a capture table, every byte goes through the engine until
+# a combo matches or none can anymore, then the normal table is back.
+#
+# In defer mode the button presses are held back until that is decided, at
+# the cost of up to the combo's window in latency. In speculate mode they go
+# out at once and are released again if a combo takes over.
+
+def key_of(b):
+    return b & ~REVERSE_MASK
+
+
+class Chord:
+    __slots__ = ('name', 'keys', 'action', 'window')
+
+    def __init__(self, name, keys, action, window=CHORD_WINDOW):
+        self.name = name
+        self.keys = frozenset(keys)
+        self.action = action
+        self.window = window
+
+    def check(self, events, expired):
+        if any(b not in self.keys for b in events):
+            return FAIL  # a release, or a button that is no part of it
+        if len(set(events)) == len(self.keys):
+            return MATCH
+        return FAIL if expired else WAIT
+
+    def __repr__(self):
+        return f'Chord(name={self.name}, action={self.action})'
+
+
+class DoubleTap:
+    __slots__ = ('name', 'key', 'action', 'window', 'taps')
+
+    def __init__(self, name, key, action, window=DOUBLE_WINDOW):
+        self.name = name
+        self.key = key
+        self.action = action
+        self.window = window
+        self.taps = [key, key | RELEASE_MASK, key]
+
+    @property
+    def keys(self):
+        return (self.key, )
+
+    def check(self, events, expired):
+        if events != self.taps[:len(events)]:
+            return FAIL
+        if len(events) == len(self.taps):
+            return MATCH
+        return FAIL if expired else WAIT
+
+    def __repr__(self):
+        return f'DoubleTap(name={self.name}, action={self.action})'
+
+
+class LongPress:
+    __slots__ = ('name', 'key', 'action', 'window')
+
+    def __init__(self, name, key, action, window=LONG_WINDOW):
+        self.name = name
+        self.key = key
+        self.action = action
+        self.window = window
+
+    @property
+    def keys(self):
+        return (self.key, )
+
+    def check(self, events, expired):
+        if events != [self.key]:
+            return FAIL
+        return MATCH if expired else WAIT
+
+    def __repr__(self):
+        return f'LongPress(name={self.name}, action={self.action})'
+
+
+COMBO_KINDS = {
+    'chord': Chord,
+    'double': DoubleTap,
+    'long': LongPress,
+}
+
+
+# Table slot for a button that starts combos; `fallback` is what the slot
+# held before, used whenever no combo claims the press.
+class ComboKey:
+    __slots__ = ('key', 'combos', 'mode', 'fallback')
+
+    def __init__(self, key, combos, mode, fallback):
+        self.key = key
+        self.combos = combos
+        self.mode = mode
+        self.fallback = fallback
+
+    def __call__(self, service):
+        service.combo.begin(self)
+
+    def __repr__(self):
+        return f'ComboKey(b{hex(self.key)}, combos={self.combos})'
+
+
+# Every slot of a capture table, while the engine is deciding.
+class Capture:
+    __slots__ = ('byte', 'handler')
+
+    def __init__(self, byte, handler):
+        self.byte = byte
+        self.handler = handler
+
+    def __call__(self, service):
+        service.combo.feed(self.byte, self.handler)
+
+    def __repr__(self):
+        return f'Capture(b{hex(self.byte)})'
+
+
+# Held under each button of a combo that fired, so releasing any of them
+# releases the combo's action, once.
+class ComboHeld:
+    __slots__ = ('action', 'held')
+
+    def __init__(self, action):
+        self.action = action
+        self.held = True
+
+    def release(self, service):
+        if self.held:
+            self.held = False
+            self.action.release(service)
+
+
+def compile_combos(table, combos, mode):
+    by_key = {}
+    for combo in combos:
+        for key in combo.keys:
+            by_key.setdefault(key, []).append(combo)
+    for key, key_combos in by_key.items():
+        handler = ComboKey(key, tuple(key_combos), mode, table[key])
+        table[key] = handler
+        table[key | REVERSE_MASK] = handler
+    return table
+
+
+def run(handler, service):
+    if isinstance(handler, ComboKey):
+        handler = handler.fallback
+    if handler is not None:
+        handler(service)
+
+
+class ComboEngine:
+    def __init__(self, service):
+        self.service = service
+        self.captures = {}  # id of a table -> its capture copy
+        self.reset()
+
+    def reset(self):
+        self.events = []  # bytes seen, reverse bit dropped
+        self.raw = []  # the same bytes as they came in
+        self.handlers = []  # what the normal table had for each of them
+        self.candidates = ()
+        self.mode = None
+        self.start = None
+        self.timer = None
+        self.deadline = None
+
+    def cancel(self):
+        # drop whatever is pending, nothing is played back
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.start is not None:
+            self.reset()
+            self.service.activate()
+
+    def capture(self, table):
+        # built from the plain handlers, so the engine sees the same
+        # ComboKeys whether or not the table is traced
+        captured = self.captures.get(id(table), None)
+        if captured is None:
+            from .dispatch import trace_table, tracing, untraced
+            captured = [
+                None if h is None else Capture(b, untraced(h))
+                for b, h in enumerate(table)
+            ]
+            if tracing():
+                captured = trace_table(captured)
+            self.captures[id(table)] = captured
+        return captured
+
+    def begin(self, key_handler):
+        service = self.service
+        self.candidates = key_handler.combos
+        self.mode = key_handler.mode
+        self.start = service.now
+        service.table = self.capture(service.table)
+        self.feed(key_handler.key, key_handler)
+
+    def feed(self, b, handler):
+        self.events.append(key_of(b))
+        self.raw.append(b)
+        self.handlers.append(handler)
+        if self.evaluate(expired=False) and self.mode == 'speculate':
+            run(handler, self.service)
+
+    def expire(self):
+        self.timer = None
+        self.evaluate(expired=True)
+        self.service.writer.syn()
+
+    def evaluate(self, expired):
+        # True while the combo is undecided
+        now = self.service.loop.time()
+        waiting = []
+        for combo in self.candidates:
+            result = combo.check(self.events, now >= self.start + combo.window)
+            if result == MATCH:
+                self.fire(combo, now)
+                return False
+            if result == WAIT:
+                waiting.append(combo)
+        if not waiting:
+            self.fail(now, pending=not expired)
+            return False
+
+        self.candidates = waiting
+        deadline = self.start + min(c.window for c in waiting)
+        if self.timer is None or self.deadline != deadline:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.deadline = deadline
+            self.timer = self.service.loop.call_at(deadline, self.expire)
+        return True
+
+    def fire(self, combo, now):
+        service = self.service
+        events, mode = self.events, self.mode
+        self.finish(combo.name, now)
+        if mode == 'speculate':
+            # take back what already went out for the buttons
+            for key in set(events):
+                service.unhold(key)
+        held = ComboHeld(combo.action)
+        for key in set(events):
+            if key & RELEASE_MASK == 0 and key not in service.held:
+                service.hold(key, held)
+        combo.action.press(service)
+
+    def fail(self, now, pending):
+        service = self.service
+        events, raw, handlers = self.events, self.raw, self.handlers
+        mode = self.mode
+        self.finish(None, now)
+        if mode == 'defer':
+            # play back what was held, except the byte that ended the wait
+            last = len(events) - 1 if pending else len(events)
+            for handler in handlers[:last]:
+                run(handler, service)
+        if pending:
+            # that one goes through the normal table and may start a combo
+            # of its own
+            handler = service.table[raw[-1]]
+            if handler is not None:
+                handler(service)
+
+    def finish(self, name, now):
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = now - self.start
+        mode = self.mode
+        self.reset()
+        self.service.activate()
+
+        if mode == 'defer':
+            metrics = self.service.metrics
+            if metrics is not None:
+                metrics.combo_delay.observe(delay)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Combo %s after %.1fms', name or 'missed',
+                             delay * 1e3)
@@ -1,12 +1,23 @@
+import hashlib
 import logging
-import toml
+import os
+import pickle
+from itertools import combinations
 from pathlib import Path
 
-from .actions import Library, ActionNone, ActionRel, ActionMenu
+from .actions import (Library, ActionNone, ActionRel, ActionMacro, ActionMenu,
+                      ActionLayout, ActionLayer, ActionToggle)
+from .combos import COMBO_KINDS, MODES, compile_combos
 from .controls import ButtonCtrl, DialCtrl, controls
+from .reader import MAP
+from .dispatch import compile_table, merge_tables
 
 logger = logging.getLogger(__name__)
 
+# layout x layer combinations resolved up front; anything beyond is merged
+# the first time it is activated
+PRERESOLVE_LIMIT = 256
+
 
 def parse_button(name, data, library):
     action_str = data if isinstance(data, str) else data['action']
@@ -15,10 +26,17 @@ def parse_button(name, data, library):
 
     if action is None:
         raise RuntimeError('bad action in ' + name)
-    if kind not in ['hold', 'up', 'down']:
+    if kind not in ['hold', 'up', 'down', 'repeat']:
         raise RuntimeError('bad kind in ' + name)
 
-    return ButtonCtrl(name, action, kind)
+    repeat = {}
+    if kind == 'repeat':
+        if 'delay' in data:
+            repeat['delay'] = parse_delay(name, data['delay'])
+        if 'rate' in data:
+            repeat['rate'] = data['rate']
+
+    return ButtonCtrl(name, action, kind, **repeat)
 
 
 def parse_dial(name, data, library):
@@ -33,7 +51,16 @@ def parse_dial(name, data, library):
         action = library.lookup(data['action'])
         if 'reverse' in data:
             reverse = library.lookup(data['reverse'])
-        rate = data['rate']
+        rate = data.get('rate', 1)
+        if 'step' in data:
+            step = data['step']
+            if not (0 < step <= 10):
+                raise RuntimeError('bad step in ' + name)
+            if not isinstance(action, ActionRel):
+                raise RuntimeError('step needs a wheel action in ' + name)
+            action = action.with_step(step)
+            if isinstance(reverse, ActionRel):
+                reverse = reverse.with_step(step)
 
     if reverse is None:
         if isinstance(action, ActionRel):
@@ -53,9 +80,71 @@ def parse_dial(name, data, library):
     return DialCtrl(name, action, reverse, rate)
 
 
+def parse_delay(name, delay):
+    # seconds, or a string such as "1.5s" or "250ms"
+    if isinstance(delay, str):
+        scale = 1
+        if delay.endswith('ms'):
+            delay, scale = delay[:-2], 0.001
+        elif delay.endswith('s'):
+            delay = delay[:-1]
+        try:
+            delay = float(delay) * scale
+        except ValueError:
+            raise RuntimeError('bad delay in ' + name)
+    if not isinstance(delay, (int, float)) or delay < 0:
+        raise RuntimeError('bad delay in ' + name)
+    return delay
+
+
+def parse_button_ref(name, ref):
+    group, _, key = ref.partition('.')
+    if controls.get(group, {}).get(key, None) != ButtonCtrl:
+        raise RuntimeError(f'no button {ref} in combo {name}')
+    return MAP[group][key].byte
+
+
+def parse_combo(name, data, library):
+    kinds = [k for k in COMBO_KINDS if k in data]
+    if len(kinds) != 1:
+        raise RuntimeError('combo needs one of chord, double or long: ' + name)
+    kind = kinds[0]
+    if len(set(data.keys()) - {kind, 'action', 'window'}) > 0:
+        raise RuntimeError('unexpected keys:' + str(data.keys()))
+    action = library.lookup(data['action'])
+
+    args = {}
+    if 'window' in data:
+        args['window'] = parse_delay(name, data['window'])
+    if kind == 'chord':
+        keys = [parse_button_ref(name, ref) for ref in data['chord']]
+        if len(set(keys)) < 2:
+            raise RuntimeError('chord needs two buttons or more: ' + name)
+        return COMBO_KINDS[kind](name, keys, action, **args)
+    key = parse_button_ref(name, data[kind])
+    return COMBO_KINDS[kind](name, key, action, **args)
+
+
+def parse_combos(layout, data, library):
+    mode = data.get('mode', 'defer')
+    if mode not in MODES:
+        raise RuntimeError('bad combo mode in layout ' + layout)
+    combos = []
+    for c_name, c_data in data.items():
+        if c_name == 'mode':
+            continue
+        combo = parse_combo(c_name, c_data, library)
+        if mode == 'defer':
+            logger.info('combo %s delays its buttons up to %.0fms',
+                        c_name, combo.window * 1e3)
+        combos.append(combo)
+    return combos, mode
+
+
 class Layout:
     def __init__(self, name, data, library):
         self.name = name
+        self.combos = []
         self.controls = {
             'prime': {},
             'kit': {},
@@ -64,11 +153,13 @@ class Layout:
             'dial': {},
         }
 
-        extra_keys = set(data.keys()) - set(controls.keys())
+        extra_keys = set(data.keys()) - set(controls.keys()) - {'combos'}
         if len(extra_keys) > 0:
             raise RuntimeError('Unexpected keys in layout:' + str(extra_keys))
 
         for s_name, s_data in data.items():
+            if s_name == 'combos':
+                continue
             for c_name, c_data in s_data.items():
                 kind = controls[s_name][c_name]
                 if kind == ButtonCtrl:
@@ -76,9 +167,23 @@ class Layout:
                 elif kind == DialCtrl:
                     control = parse_dial(c_name, c_data, library)
                 else:
-                    raise Error('Bad control kind')
+                    raise RuntimeError('Bad control kind')
                 self.controls[s_name][c_name] = control
 
+        self.table = compile_table(self.controls)
+        if 'combos' in data:
+            self.combos, mode = parse_combos(name, data['combos'], library)
+            compile_combos(self.table, self.combos, mode)
+
+    def actions(self):
+        for group in self.controls.values():
+            for ctrl in group.values():
+                yield ctrl.action
+                if isinstance(ctrl, DialCtrl):
+                    yield ctrl.reverse
+        for combo in self.combos:
+            yield combo.action
+
     def __repr__(self):
         return f'Layout(name={self.name})'
 
@@ -86,11 +191,15 @@ class Layout:
 class Config:
     def __init__(self, data):
         self.name = data['name']
+        self.path = None
         self.library = Library()
         self.layouts = {}
         self.shortcuts = {}
         self.macros = {}
         self.menus = {}
+        self.order = {}  # layout name -> stacking order of its layer
+        self.stacks = {}  # (layout, layers) -> merged table
+        self.apps = {}  # lower case window class -> layout, '*' for others
 
         if data['name'] is None:
             raise RuntimeError('no name')
@@ -98,10 +207,15 @@ class Config:
             raise RuntimeError('no layouts')
         if data['layouts']['main'] is None:
             raise RuntimeError('no main layout')
-        expected_keys = {'name', 'layouts', 'shortcuts', 'macros', 'menus'}
+        expected_keys = {'name', 'layouts', 'shortcuts', 'macros', 'menus',
+                         'apps'}
         if len(set(data.keys()) - expected_keys) > 0:
             raise RuntimeError('unexpected keys:' + str(data.keys()))
 
+        # before anything else so macros and menus can switch layouts too
+        for l_name in data['layouts']:
+            self.register_layout_actions(l_name)
+
         for s_name, s_data in data['shortcuts'].items():
             self.register_shortcut(s_name, s_data)
 
@@ -114,6 +228,12 @@ class Config:
         for l_name, l_data in data['layouts'].items():
             self.register_layout(l_name, l_data)
 
+        for a_name, a_data in data.get('apps', {}).items():
+            self.register_app(a_name, a_data)
+
+        self.preresolve()
+        self.codes = self.collect_codes()
+
     def register_shortcut(self, name, data):
         if isinstance(data, str):
             action = self.library.lookup(data)
@@ -122,27 +242,119 @@ class Config:
             if len(set(data.keys()) - expected_keys) > 0:
                 raise RuntimeError('unexpected keys:' + str(data.keys()))
             action = self.library.lookup(data['action'])
-            mods = {'shift', 'ctrl', 'alt', 'super'}
-            mod_data = {k: data[k] for k in mods if k in data}
+            mods = {'shift': 'shift', 'ctrl': 'ctrl', 'alt': 'alt', 'super': 'cmd'}
+            mod_data = {m: data[k] for k, m in mods.items() if k in data}
             action = action.with_mods(**mod_data)
 
         self.shortcuts[name] = action
         self.library.push(action.with_name(name))
 
     def register_macro(self, name, data):
-        pass
+        expected_keys = {'entries', 'repeat'}
+        if len(set(data.keys()) - expected_keys) > 0:
+            raise RuntimeError('unexpected keys:' + str(data.keys()))
+        repeat = data.get('repeat', 1)
+        if not isinstance(repeat, int) or repeat < 1:
+            raise RuntimeError('bad repeat in macro ' + name)
+
+        # consecutive entries without a delay between them are one step
+        steps = []
+        actions = []
+        for entry in data['entries']:
+            if 'action' in entry:
+                count = entry.get('repeat', 1)
+                if not isinstance(count, int) or count < 1:
+                    raise RuntimeError('bad repeat in macro ' + name)
+                actions.extend([self.library.lookup(entry['action'])] * count)
+            elif 'text' in entry:
+                actions.extend(self.library.text(entry['text']))
+            elif 'delay' in entry:
+                steps.append((actions, parse_delay(name, entry['delay'])))
+                actions = []
+            else:
+                raise RuntimeError('bad entry in macro ' + name)
+        if actions:
+            steps.append((actions, 0))
+
+        macro = ActionMacro(name, steps, repeat)
+        self.macros[name] = macro
+        self.library.push(macro)
 
     def register_menu(self, name, data):
         if data['entries'] is None:
             raise RuntimeError('no entries')
+        for entry in data['entries']:
+            if 'name' not in entry or 'action' not in entry:
+                raise RuntimeError('bad entry in menu ' + name)
         self.library.push(ActionMenu(name, data['entries']))
 
+    def register_layout_actions(self, name):
+        self.order[name] = len(self.order)
+        self.library.push(ActionLayout('layout:' + name, name))
+        self.library.push(ActionLayer('layer:' + name, name))
+        self.library.push(ActionToggle('toggle:' + name, name))
+
     def register_layout(self, name, data):
         layout = Layout(name, data, self.library)
         self.layouts[layout.name] = layout
 
+    def register_app(self, wm_class, layout):
+        if layout not in self.layouts:
+            raise RuntimeError(f'unknown layout {layout} for app {wm_class}')
+        self.apps[wm_class.lower()] = layout
+
+    def stack(self, layers):
+        # layers stack in config order, whatever order they came on in
+        return tuple(sorted(layers, key=self.order.__getitem__))
+
+    def resolve(self, layout, layers=()):
+        if not layers:
+            return self.layouts[layout].table
+        key = (layout, layers)
+        table = self.stacks.get(key, None)
+        if table is None:
+            tables = [self.layouts[name].table for name in reversed(layers)]
+            tables.append(self.layouts[layout].table)
+            table = self.stacks[key] = merge_tables(tables)
+        return table
+
+    def collect_codes(self):
+        # everything any binding can send, so the output device need not
+        # claim every key there is
+        actions = list(self.shortcuts.values()) + list(self.macros.values())
+        for layout in self.layouts.values():
+            actions.extend(layout.actions())
+        for menu in self.library.cmds.values():
+            if not isinstance(menu, ActionMenu):
+                continue
+            for entry in menu.entries:
+                if entry['action'] in self.layouts:
+                    continue
+                try:
+                    actions.append(self.library.lookup(entry['action']))
+                except KeyError:
+                    logger.warning('unknown action in menu %s: %s',
+                                   menu.name, entry['action'])
+        return frozenset(code for action in actions
+                         for code in action.codes())
+
+    def preresolve(self):
+        layers = set()
+        for layout in self.layouts.values():
+            for action in layout.actions():
+                if isinstance(action, (ActionLayer, ActionToggle)):
+                    layers.add(action.layout)
+        layers = self.stack(layers)
+        if len(self.layouts) << len(layers) > PRERESOLVE_LIMIT:
+            logger.info('%d layers, stacks resolved on first use', len(layers))
+            return
+        for layout in self.layouts:
+            for n in range(1, len(layers) + 1):
+                for combo in combinations(layers, n):
+                    self.resolve(layout, combo)
+
     @staticmethod
-    def from_file(config_path):
+    def find(config_path):
         if config_path is None:
             config_path = Path.home() / '.tourboxneo'
         if not config_path.exists():
@@ -150,13 +362,75 @@ class Config:
             config_path = Path(__file__).with_name('default.toml')
         if not config_path.exists():
             raise RuntimeError('No default configuration available')
+        return config_path
 
+    @staticmethod
+    def from_file(config_path, cache=True):
+        config_path = Config.find(config_path)
         logger.info('reading %s', config_path.name)
 
-        with config_path.open('r') as config_text:
-            data = toml.loads(config_text.read())
-            config = Config(data)
+        text = config_path.read_bytes()
+        cache_path = cache_file(text) if cache else None
+        config = load_cached(cache_path) if cache_path else None
+        if config is None:
+            import toml
+            config = Config(toml.loads(text.decode('utf-8')))
+            if cache_path:
+                store_cached(cache_path, config)
+        config.path = config_path
 
         logger.info('loaded %s', config_path.name)
 
         return config
+
+
+# A compiled config (library, layouts and their dispatch tables) is pickled
+# under the cache dir, named after a hash of the TOML and of the package's
+# sources, so an unchanged file skips toml and the library entirely, and
+# any edit or upgrade of the classes that get pickled starts a fresh cache.
+# The sources go in by name, size and mtime; stat is cheaper than reading
+# them and any install or edit changes the mtime.
+_sources_key = None
+
+
+def sources_key():
+    global _sources_key
+    if _sources_key is None:
+        stats = []
+        for entry in os.scandir(os.path.dirname(__file__)):
+            if entry.name.endswith('.py'):
+                st = entry.stat()
+                stats.append(f'{entry.name}:{st.st_size}:{st.st_mtime_ns}')
+        _sources_key = '\n'.join(sorted(stats)).encode()
+    return _sources_key
+
+
+def cache_file(text):
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    digest = hashlib.sha256(sources_key() + b'\0' + text).hexdigest()
+    return Path(base) / 'tourboxneo' / f'{digest}.pickle'
+
+
+def load_cached(cache_path):
+    try:
+        with cache_path.open('rb') as cached:
+            config = pickle.load(cached)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        logger.warning('ignoring config cache %s: %s', cache_path.name, err)
+        return None
+    logger.debug('config from cache %s', cache_path.name)
+    return config
+
+
+def store_cached(cache_path, config):
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tmp_path.open('wb') as cached:
+            pickle.dump(config, cached, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as err:
+        logger.warning('could not write config cache: %s', err)
+        tmp_path.unlink(missing_ok=True)
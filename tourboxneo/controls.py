@@ -1,38 +1,54 @@
 import logging
 
-from .actions import Action
+from .actions import Action, Frozen
 from .reader import MAP
 
 logger = logging.getLogger(__name__)
 
+# seconds between dial detents: at or above SLOW a detent counts once, at or
+# below FAST it counts `rate` times, in between the gain is interpolated
+ACCEL_SLOW = 0.150
+ACCEL_FAST = 0.015
 
-class Control:
-    pass
+# kind = "repeat": seconds before the first repeat, then repeats per second
+REPEAT_DELAY = 0.4
+REPEAT_RATE = 25
+
+
+class Control(Frozen):
+    __slots__ = ()
 
 
 class ButtonCtrl(Control):
-    def __init__(self, name, action, kind):
-        self.name = name
-        self.action = action
-        self.kind = kind
+    __slots__ = ('name', 'action', 'kind', 'delay', 'rate')
+
+    def __init__(self, name, action, kind, delay=REPEAT_DELAY,
+                 rate=REPEAT_RATE):
+        self.set(name=name, action=action, kind=kind, delay=delay, rate=rate)
 
         if self.action is None:
             raise RuntimeError('bad action in ' + name)
         if not isinstance(self.action, Action):
             raise RuntimeError('bad action in ' + name)
-        if self.kind not in ['hold', 'up', 'down']:
+        if self.kind not in ['hold', 'up', 'down', 'repeat']:
             raise RuntimeError('bad kind in ' + name)
+        if not (0 <= self.delay <= 5):
+            raise RuntimeError('bad delay in ' + name)
+        if not (0 < self.rate <= 100):
+            raise RuntimeError('bad rate in ' + name)
 
     def __repr__(self):
+        if self.kind == 'repeat':
+            return (f'ButtonCtrl(name={self.name}, action={self.action}, '
+                    f'kind=repeat, delay={self.delay}, rate={self.rate})')
         return f'ButtonCtrl(name={self.name}, action={self.action}, kind={self.kind})'
 
 
 class DialCtrl(Control):
+    __slots__ = ('name', 'action', 'reverse', 'rate')
+
     def __init__(self, name, action, reverse, rate):
-        self.name = name
-        self.action = action
-        self.reverse = reverse
-        self.rate = rate
+        self.set(name=name, action=action, reverse=reverse, rate=rate)
 
         if self.action is None:
             raise RuntimeError('bad action in ' + name)
@@ -45,6 +61,14 @@ class DialCtrl(Control):
         if not (1 <= self.rate <= 5):
             raise RuntimeError('bad rate in ' + name)
 
+    def gain(self, interval):
+        if interval >= ACCEL_SLOW:
+            return 1
+        if interval <= ACCEL_FAST:
+            return self.rate
+        speed = (ACCEL_SLOW - interval) / (ACCEL_SLOW - ACCEL_FAST)
+        return 1 + (self.rate - 1) * speed
+
     def __repr__(self):
         return f'DialCtrl(name={self.name}, action={self.action}, reverse={self.reverse}, rate={self.rate})'
 
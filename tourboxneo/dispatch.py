@@ -0,0 +1,222 @@
+import logging
+
+from .actions import ActionNone
+from .combos import ComboKey
+from .controls import DialCtrl, clobbers, controls as kinds
+from .reader import BUTTONS, BYTEMAP, BUTTON_MASK, RELEASE_MASK, REVERSE_MASK
+
+logger = logging.getLogger(__name__)
+
+
+# Every slot of a compiled table is either None (nothing to do) or one of the
+# handlers below, called with the service. Anything that depends on the layout
+# is resolved when the table is built, not when the byte arrives. Handlers
+# don't log; with debug logging on the service runs a traced copy of the
+# table instead, so tracing costs nothing while it is off.
+
+class Unknown:
+    __slots__ = ('byte', )
+
+    def __init__(self, byte):
+        self.byte = byte
+
+    def __call__(self, service):
+        logger.warning('Unknown byte %#x', self.byte)
+        if service.metrics is not None:
+            service.metrics.count('unknown_bytes')
+
+    def __repr__(self):
+        return f'Unknown(b{hex(self.byte)})'
+
+
+class Press:
+    __slots__ = ('key', 'ctrl', 'action', 'clobbers')
+
+    def __init__(self, btn, ctrl, clobbers):
+        self.key = btn.byte
+        self.ctrl = ctrl
+        self.action = ctrl.action
+        self.clobbers = clobbers
+
+    def __repr__(self):
+        name = type(self).__name__
+        return f'{name}(ctrl={self.ctrl}, clobbers={self.clobbers})'
+
+
+class HoldPress(Press):
+    __slots__ = ()
+
+    def __call__(self, service):
+        service.clobber(self.clobbers)
+        if service.hold(self.key, self):
+            self.action.press(service)
+
+    def release(self, service):
+        self.action.release(service)
+
+
+class UpPress(Press):
+    __slots__ = ()
+
+    def __call__(self, service):
+        service.clobber(self.clobbers)
+        service.hold(self.key, self)
+
+    def release(self, service):
+        self.action.tap(service)
+
+
+class DownPress(Press):
+    __slots__ = ()
+
+    def __call__(self, service):
+        service.clobber(self.clobbers)
+        self.action.tap(service)
+
+
+# Taps at once, then again every 1/rate seconds after `delay` until
+# released. Repeats are loop timers, one per held button, all in the loop's
+# single timer heap.
+class RepeatPress(Press):
+    __slots__ = ()
+
+    def __call__(self, service):
+        service.clobber(self.clobbers)
+        if not service.hold(self.key, self):
+            return
+        self.action.tap(service)
+        self.schedule(service, service.loop.time() + self.ctrl.delay)
+
+    def schedule(self, service, when):
+        timer = service.loop.call_at(when, self.repeat, service)
+        service.repeats[self.key] = (when, timer)
+
+    def repeat(self, service):
+        when, _ = service.repeats[self.key]
+        self.action.tap(service)
+        service.writer.syn()
+        # from the time it was due, so a busy loop doesn't stretch the rate
+        self.schedule(service, max(when + 1 / self.ctrl.rate,
+                                   service.loop.time()))
+
+    def release(self, service):
+        repeat = service.repeats.pop(self.key, None)
+        if repeat is not None:
+            repeat[1].cancel()
+
+
+class Turn:
+    __slots__ = ('key', 'ctrl', 'action', 'clobbers')
+
+    def __init__(self, key, ctrl, action, clobbers):
+        self.key = key
+        self.ctrl = ctrl
+        self.action = action
+        self.clobbers = clobbers
+
+    def __call__(self, service):
+        service.clobber(self.clobbers)
+        count = service.detents(self.key, self.ctrl)
+        self.action.tap(service, count)
+
+    def __repr__(self):
+        return f'Turn(action={self.action}, clobbers={self.clobbers})'
+
+
+class Traced:
+    __slots__ = ('byte', 'handler')
+
+    def __init__(self, byte, handler):
+        self.byte = byte
+        self.handler = handler
+
+    def __call__(self, service):
+        logger.debug('b%#x: %r', self.byte, self.handler)
+        self.handler(service)
+
+    def __repr__(self):
+        return f'Traced({self.handler!r})'
+
+
+class Release:
+    __slots__ = ('key', )
+
+    def __init__(self, btn):
+        self.key = btn.byte
+
+    def __call__(self, service):
+        service.unhold(self.key)
+
+    def __repr__(self):
+        return f'Release(b{hex(self.key)})'
+
+
+PRESS_KINDS = {
+    'hold': HoldPress,
+    'up': UpPress,
+    'down': DownPress,
+    'repeat': RepeatPress,
+}
+
+
+def compile_table(controls):
+    table = [None] * 256
+    for b in range(256):
+        if BYTEMAP.get(b & BUTTON_MASK, None) is None:
+            table[b] = Unknown(b)
+
+    for btn in BUTTONS:
+        cbs = tuple(c.byte for c in clobbers[btn.group].get(btn.key, ()))
+        ctrl = controls[btn.group].get(btn.key, None)
+
+        if kinds[btn.group][btn.key] == DialCtrl:
+            if ctrl is None:
+                continue
+            for b, action in ((btn.byte, ctrl.action),
+                              (btn.byte | REVERSE_MASK, ctrl.reverse)):
+                if not isinstance(action, ActionNone):
+                    table[b] = Turn(b, ctrl, action, cbs)
+            continue
+
+        # releases are always dispatched, the held map decides what they do
+        release = Release(btn)
+        table[btn.byte | RELEASE_MASK] = release
+        table[btn.byte | RELEASE_MASK | REVERSE_MASK] = release
+
+        if ctrl is None or isinstance(ctrl.action, ActionNone):
+            continue
+        press = PRESS_KINDS[ctrl.kind](btn, ctrl, cbs)
+        table[btn.byte] = press
+        table[btn.byte | REVERSE_MASK] = press
+
+    return table
+
+
+def merge_tables(tables):
+    # tables are given from the top of the stack down; empty slots fall
+    # through to the layers below
+    merged = list(tables[-1])
+    for table in reversed(tables[:-1]):
+        for b, handler in enumerate(table):
+            if handler is None:
+                continue
+            if isinstance(handler, ComboKey) and handler.fallback is None:
+                # a combo button the layer doesn't bind on its own does
+                # whatever it does below when no combo claims it
+                handler = ComboKey(handler.key, handler.combos, handler.mode,
+                                   merged[b])
+            merged[b] = handler
+    return merged
+
+
+def tracing():
+    return logger.isEnabledFor(logging.DEBUG)
+
+
+def trace_table(table):
+    return [None if handler is None else Traced(b, handler)
+            for b, handler in enumerate(table)]
+
+
+def untraced(handler):
+    return handler.handler if isinstance(handler, Traced) else handler
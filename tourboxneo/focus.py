@@ -0,0 +1,123 @@
+import logging
+
+try:
+    from Xlib import X, display as xdisplay, error as xerror
+except ImportError:
+    X = None
+
+from .listener import UnixListener
+
+logger = logging.getLogger(__name__)
+
+
+# Focus sources call back with the window class of the newly focused window
+# and the loop time its notification was read at. Both only wake up when
+# focus actually changes.
+
+def open_focus(loop, spec, callback):
+    if spec == 'x11':
+        return X11Focus(loop, callback)
+    if spec.startswith('unix:'):
+        return SocketFocus(loop, spec[len('unix:'):], callback)
+    raise RuntimeError(f'Unknown focus source: {spec}')
+
+
+# _NET_ACTIVE_WINDOW changes on the root window, as set by any EWMH window
+# manager. Needs python-xlib.
+class X11Focus:
+    def __init__(self, loop, callback):
+        if X is None:
+            raise RuntimeError('X11 focus tracking needs python-xlib')
+        self.loop = loop
+        self.callback = callback
+        self.display = xdisplay.Display()
+        self.root = self.display.screen().root
+        self.active = self.display.intern_atom('_NET_ACTIVE_WINDOW')
+        self.root.change_attributes(event_mask=X.PropertyChangeMask)
+        self.display.flush()
+        self.fd = self.display.fileno()
+        loop.add_reader(self.fd, self.receive)
+        logger.info('Following X11 window focus')
+        self.report(loop.time())
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        self.display.close()
+
+    def receive(self):
+        now = self.loop.time()
+        changed = False
+        try:
+            for _ in range(self.display.pending_events()):
+                event = self.display.next_event()
+                if (event.type == X.PropertyNotify
+                        and event.atom == self.active):
+                    changed = True
+            if changed:
+                self.report(now)
+        except xerror.ConnectionClosedError as err:
+            # the session ended, the fd would stay readable forever
+            logger.warning('X server went away, not following focus: %s',
+                           err)
+            self.loop.remove_reader(self.fd)
+
+    def report(self, now):
+        prop = self.root.get_full_property(self.active, X.AnyPropertyType)
+        if prop is None or not prop.value or not prop.value[0]:
+            return
+        window = self.display.create_resource_object('window', prop.value[0])
+        try:
+            wm_class = window.get_wm_class()
+        except xerror.XError:
+            return  # closed before we got to it
+        if wm_class:
+            self.callback(wm_class[-1], now)
+
+
+# Newline separated window classes (or Wayland app ids) written to a Unix
+# socket, for compositors and scripts that know what has focus, e.g.
+#     swaymsg -m -t subscribe '["window"]' | jq --unbuffered -r \
+#         'select(.change == "focus") | .container.app_id' | socat - UNIX:PATH
+class SocketFocus:
+    def __init__(self, loop, path, callback):
+        self.loop = loop
+        self.callback = callback
+        self.clients = {}  # fd -> (socket, partial line)
+        self.listener = UnixListener(loop, path, self.connected)
+        logger.info('Reading window focus from %s', path)
+
+    def close(self):
+        for fd in list(self.clients):
+            self.drop(fd)
+        self.listener.close()
+
+    def connected(self, conn):
+        conn.setblocking(False)
+        self.clients[conn.fileno()] = (conn, b'')
+        self.loop.add_reader(conn.fileno(), self.receive, conn.fileno())
+
+    def drop(self, fd):
+        conn, _ = self.clients.pop(fd)
+        self.loop.remove_reader(fd)
+        conn.close()
+
+    def receive(self, fd):
+        now = self.loop.time()
+        conn, partial = self.clients[fd]
+        try:
+            data = conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(fd)
+            return
+        *lines, partial = (partial + data).split(b'\n')
+        self.clients[fd] = (conn, partial)
+        # only the latest focus in a burst matters
+        for line in reversed(lines):
+            wm_class = line.strip().decode('utf-8', 'replace')
+            if wm_class:
+                self.callback(wm_class, now)
+                break
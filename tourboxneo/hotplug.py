@@ -0,0 +1,74 @@
+import logging
+import socket
+from pathlib import Path
+
+from .reader import is_tourbox
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+logger = logging.getLogger(__name__)
+
+NETLINK_KOBJECT_UEVENT = 15
+KERNEL_GROUP = 1
+
+
+# Calls back with the device node whenever a TourBox tty appears. Nothing
+# runs while no device events arrive: the socket just sits in the loop.
+class Hotplug:
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+        self.monitor = None
+        self.sock = None
+
+        if pyudev is not None:
+            # udev events come after rules ran, so the node is ready to open
+            context = pyudev.Context()
+            self.monitor = pyudev.Monitor.from_netlink(context)
+            self.monitor.filter_by(subsystem='tty')
+            self.monitor.start()
+            fd = self.monitor.fileno()
+            loop.add_reader(fd, self.receive_udev)
+        else:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                      NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, KERNEL_GROUP))
+            self.sock.setblocking(False)
+            fd = self.sock.fileno()
+            loop.add_reader(fd, self.receive_kernel)
+        self.fd = fd
+        logger.info('Watching for hotplug events')
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        if self.sock is not None:
+            self.sock.close()
+
+    def receive_udev(self):
+        while (device := self.monitor.poll(timeout=0)) is not None:
+            if device.action == 'add' and device.device_node is not None:
+                self.added(device.sys_name, Path(device.device_node))
+
+    def receive_kernel(self):
+        while True:
+            try:
+                data = self.sock.recv(16384)
+            except BlockingIOError:
+                return
+            # 'add@/devices/...' followed by NUL separated KEY=VALUE pairs
+            fields = data.split(b'\0')
+            env = dict(f.decode(errors='replace').split('=', 1)
+                       for f in fields[1:] if b'=' in f)
+            if env.get('ACTION') != 'add' or env.get('SUBSYSTEM') != 'tty':
+                continue
+            name = env.get('DEVNAME', '')
+            self.added(Path(name).name, Path('/dev', name))
+
+    def added(self, name, dev_path):
+        if not is_tourbox(name):
+            return
+        logger.info('Device plugged in: %s', dev_path)
+        self.callback(dev_path)
@@ -0,0 +1,41 @@
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+
+# A Unix stream socket on the loop that hands every new connection to
+# on_connect(conn). Used by the event stream sink, the focus socket and the
+# metrics exporter; whatever was at the path before is replaced.
+class UnixListener:
+    def __init__(self, loop, path, on_connect):
+        self.loop = loop
+        self.path = path
+        self.on_connect = on_connect
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.bind(path)
+            self.sock.listen()
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+        loop.add_reader(self.sock.fileno(), self.accept)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def accept(self):
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        self.on_connect(conn)
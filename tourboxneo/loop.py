@@ -0,0 +1,142 @@
+import heapq
+import logging
+import os
+import select
+import signal
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __repr__(self):
+        return f'Timer(when={self.when}, callback={self.callback})'
+
+
+# Waits on every registered fd, the nearest timer and a self-pipe at once, so
+# an idle service sleeps in the kernel until there is work to do. Method names
+# follow asyncio's loop so either one can drive a Service.
+class Loop:
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.readers = {}
+        self.timers = []
+        self.pending = []  # callbacks handed over from other threads
+        self.exiting = False
+        self.signals = False
+        self.polled = 0.0
+        self.wake_r, self.wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.add_reader(self.wake_r, self.wakeup)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.signals:
+            signal.set_wakeup_fd(-1)
+        self.epoll.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def time(self):
+        return monotonic()
+
+    def add_reader(self, fd, callback, *args):
+        if fd in self.readers:
+            self.epoll.modify(fd, select.EPOLLIN)
+        else:
+            self.epoll.register(fd, select.EPOLLIN)
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        if self.readers.pop(fd, None) is None:
+            return False
+        try:
+            self.epoll.unregister(fd)
+        except (OSError, ValueError):
+            pass  # fd already closed
+        return True
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(monotonic() + delay, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.pending.append((callback, args))
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            pass  # pipe is full, so a wakeup is already on its way
+
+    def add_signal_handler(self, sig, callback, *args):
+        # the C-level handler writes to the pipe, which interrupts poll()
+        signal.set_wakeup_fd(self.wake_w)
+        self.signals = True
+        signal.signal(sig, lambda signum, frame: callback(*args))
+
+    def wakeup(self):
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.pending:
+            callback, args = self.pending.pop(0)
+            self.call(callback, args)
+
+    def stop(self):
+        self.exiting = True
+
+    def run(self):
+        self.exiting = False
+        while not self.exiting:
+            self.run_once()
+
+    def run_once(self):
+        timers = self.timers
+        while timers and timers[0].cancelled:
+            heapq.heappop(timers)
+        timeout = -1
+        if timers:
+            timeout = max(timers[0].when - monotonic(), 0)
+
+        events = self.epoll.poll(timeout)
+        self.polled = monotonic()  # when the handlers below became ready
+        for fd, mask in events:
+            handler = self.readers.get(fd)
+            if handler is not None:
+                callback, args = handler
+                self.call(callback, args)
+
+        now = monotonic()
+        while timers and timers[0].when <= now:
+            timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                self.call(timer.callback, timer.args)
+
+    def call(self, callback, args):
+        # like asyncio, a failing callback is logged and the rest carry on,
+        # so one broken source doesn't take every device down with it
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception('Error in %r', callback)
@@ -1,9 +1,9 @@
 import logging
-import toml
-import time
+import os
 import tkinter as tk
 from tkinter import ttk
-from threading import *
+from queue import Queue, Empty
+from threading import Thread
 
 logger = logging.getLogger(__name__)
 
@@ -14,36 +14,79 @@ SMALL_FONT = ('Helvetica', 8)
 
 gui_thread = None
 
-def start_tk(tk):
-    tk.mainloop()
 
+def show_menu(name, entries, callback):
+    global gui_thread
+    if gui_thread is None or not gui_thread.is_alive():
+        gui_thread = GuiThread()
+        gui_thread.start()
+    gui_thread.show(name, entries, callback)
 
-class Menu(tk.Tk):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+
+# Owns the Tk root for the whole process; Tk may only be touched from the
+# thread that created it. Requests arrive through a queue and a pipe the Tk
+# event loop watches, so the thread sleeps until a menu is wanted.
+class GuiThread(Thread):
+    def __init__(self):
+        super().__init__(name='tourboxneo-gui', daemon=True)
+        self.requests = Queue()
+        self.wake_r, self.wake_w = os.pipe()
+
+    def show(self, name, entries, callback):
+        self.requests.put((name, entries, callback))
+        os.write(self.wake_w, b'\0')
+
+    def run(self):
+        root = tk.Tk()
+        root.withdraw()
+        root.tk.createfilehandler(self.wake_r, tk.READABLE, self.wakeup)
+        self.root = root
+        root.mainloop()
+
+    def wakeup(self, fd, mask):
+        os.read(fd, 4096)
+        while True:
+            try:
+                name, entries, callback = self.requests.get_nowait()
+            except Empty:
+                break
+            Menu(self.root, name, entries, callback)
+
+
+class Menu(tk.Toplevel):
+    def __init__(self, root, name, entries, callback):
+        super().__init__(root)
+        self.callback = callback
 
         # basic setup
         self.overrideredirect(True)
         self.wm_title('TourBoxNeo Menu')
 
         # callbacks
-        self.bind('<FocusIn>', self.focus_in)
         self.bind('<FocusOut>', self.focus_out)
+        self.bind('<Escape>', lambda event: self.destroy())
 
         close = ttk.Button(self, text='x', command=self.destroy)
-        close.pack(side='right')
-        label = ttk.Label(self, text='foo', font=FONT)
+        close.pack(side='right', anchor='n')
+        label = ttk.Label(self, text=name, font=FONT)
         label.pack(side='top', fill='x', pady=10)
+        for entry in entries:
+            button = ttk.Button(self,
+                                text=entry['name'],
+                                command=lambda entry=entry: self.pick(entry))
+            button.pack(side='top', fill='x')
 
         # position
-        abs_x = self.winfo_pointerx() - self.winfo_rootx()
-        abs_y = self.winfo_pointery() - self.winfo_rooty()
-        self.geometry('+{0}+{1}'.format(abs_x, abs_y))
+        x, y = self.winfo_pointerxy()
+        self.geometry('+{0}+{1}'.format(x, y))
         self.update_idletasks()
+        self.focus_force()
 
-    def focus_in(self, event):
-        print('focus in')
+    def pick(self, entry):
+        logger.debug('Menu entry picked: %s', entry['name'])
+        self.destroy()
+        self.callback(entry)
 
     def focus_out(self, event):
-        print('focus out')
-        self.destroy()
+        if event.widget is self:
+            self.destroy()
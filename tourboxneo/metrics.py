@@ -0,0 +1,157 @@
+import logging
+import os
+from bisect import bisect_left
+
+from .listener import UnixListener
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, the last bucket takes everything above
+BUCKETS = (10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 500e-6,
+           1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3)
+
+COUNTERS = {
+    'bytes': 'Bytes read from devices',
+    'batches': 'Reads handed to the dispatch table',
+    'unknown_bytes': 'Bytes that map to no control',
+    'connects': 'Device connections',
+    'disconnects': 'Device losses',
+    'double_holds': 'Presses of a control that was already held',
+    'dropped_reports': 'Output writes that failed',
+}
+
+EXPORT_INTERVAL = 15  # seconds between text file updates
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket the quantile falls in
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} histogram')
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {seen}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum:.9f}')
+        lines.append(f'{self.name}_count {self.count}')
+
+
+# Per stage timings of Service.tick_metered. Services only use it when one
+# is set, otherwise they run the plain tick and nothing is measured.
+class Metrics:
+    def __init__(self):
+        self.read = Histogram('tourboxneo_read_seconds',
+                              'Reading one batch from the device')
+        self.dispatch = Histogram('tourboxneo_dispatch_seconds',
+                                  'Running one batch through the layout table')
+        self.emit = Histogram('tourboxneo_emit_seconds',
+                              'Flushing one batch to the output device')
+        self.latency = Histogram('tourboxneo_latency_seconds',
+                                 'Input readable to output written')
+        self.combo_delay = Histogram('tourboxneo_combo_delay_seconds',
+                                     'Input held back to recognize a combo')
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def render(self):
+        lines = []
+        for histogram in (self.read, self.dispatch, self.emit, self.latency,
+                          self.combo_delay):
+            histogram.render(lines)
+        for name, value in self.counters.items():
+            lines.append(f'# HELP tourboxneo_{name}_total {COUNTERS[name]}')
+            lines.append(f'# TYPE tourboxneo_{name}_total counter')
+            lines.append(f'tourboxneo_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        latency = self.latency
+        return (f'{latency.count} batches, latency p50 <= '
+                f'{latency.quantile(.5) * 1e3:g}ms, p99 <= '
+                f'{latency.quantile(.99) * 1e3:g}ms')
+
+
+def open_exporter(loop, metrics, spec):
+    if spec.startswith('unix:'):
+        return SocketExporter(loop, metrics, spec[len('unix:'):])
+    if spec.startswith('file:'):
+        return FileExporter(loop, metrics, spec[len('file:'):])
+    raise RuntimeError(f'Unknown metrics target: {spec}')
+
+
+# Every connection gets the current metrics and is closed, so
+#     socat - UNIX:PATH
+# prints them.
+class SocketExporter:
+    def __init__(self, loop, metrics, path):
+        self.metrics = metrics
+        self.listener = UnixListener(loop, path, self.connected)
+        logger.info('Serving metrics on %s', path)
+
+    def close(self):
+        self.listener.close()
+        logger.info('Metrics: %s', self.metrics.summary())
+
+    def connected(self, conn):
+        with conn:
+            conn.settimeout(1)
+            try:
+                conn.sendall(self.metrics.render().encode())
+            except OSError as err:
+                logger.debug('Metrics client went away: %s', err)
+
+
+# For node_exporter's textfile collector: rewritten every EXPORT_INTERVAL
+# seconds, by rename so the collector never reads half a file.
+class FileExporter:
+    def __init__(self, loop, metrics, path):
+        self.loop = loop
+        self.metrics = metrics
+        self.path = path
+        self.timer = None
+        self.export()
+        logger.info('Writing metrics to %s', path)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.write()
+        logger.info('Metrics: %s', self.metrics.summary())
+
+    def export(self):
+        self.write()
+        self.timer = self.loop.call_later(EXPORT_INTERVAL, self.export)
+
+    def write(self):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as out:
+                out.write(self.metrics.render())
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            logger.warning('Could not write metrics: %s', err)
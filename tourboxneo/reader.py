@@ -1,5 +1,4 @@
 from dataclasses import dataclass
-from evdev import UInput, ecodes as e
 from pathlib import Path
 import serial
 import logging
@@ -12,8 +11,10 @@ BUTTON_MASK = ~(RELEASE_MASK | REVERSE_MASK)
 UEVENT_PRODUCT = 'PRODUCT=2e3c/5740/200'
 
 
-@dataclass
+@dataclass(frozen=True)
 class Button:
+    __slots__ = ('group', 'key', 'byte')
+
     group: str
     key: str
     byte: int
@@ -89,17 +90,25 @@ MAP = {
 }
 
 
+def is_tourbox(tty_name):
+    uevent = Path('/sys/class/tty/', tty_name, 'device/uevent')
+    try:
+        return UEVENT_PRODUCT in uevent.read_text()
+    except OSError:
+        return False
+
+
 class Reader:
-    def __init__(self, dev_path):
+    def __init__(self, dev_path, exclude=()):
         if dev_path is not None and not dev_path.exists():
-            logger.warn('Specified device does not exist')
+            logger.warning('Specified device does not exist')
             dev_path = None
         if dev_path is None:
             logger.info('Searching for device')
-            for d in Path('/sys/class/tty/').glob('*ACM*'):
-                uevent = d.joinpath('device/uevent').read_text()
-                if UEVENT_PRODUCT in uevent:
-                    dev_path = Path('/dev').joinpath(d.name)
+            for d in sorted(Path('/sys/class/tty/').glob('*ACM*')):
+                path = Path('/dev').joinpath(d.name)
+                if path.resolve() not in exclude and is_tourbox(d.name):
+                    dev_path = path
                     logger.info('Identified device %s', dev_path)
                     break
         if dev_path is None or not dev_path.exists():
@@ -110,26 +119,36 @@ class Reader:
 
     def __enter__(self):
         logger.info('Starting TourBox Reader')
-        self.serial = serial.Serial(str(self.dev_path), timeout=2)
+        self.serial = serial.Serial(str(self.dev_path), timeout=0)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         logger.info('Halting TourBox Reader')
+        self.serial.close()
 
-    def tick(self):
+    def fileno(self):
+        return self.serial.fileno()
+
+    def read(self):
         try:
-            bs = self.serial.read()
-        except serial.SerialException:
+            bs = self.serial.read(max(self.serial.in_waiting, 1))
+            if not bs:
+                raise serial.SerialException('readable but no data')
+        except (serial.SerialException, OSError):
             msg = 'Can\'t read: %s, maybe unplugged or no permission?'
             logging.error(msg, self.dev_path)
             raise RuntimeError('Lost device')
-
-        if len(bs) > 0:
-            b = bs[0]
-            btn = BYTEMAP.get(b & BUTTON_MASK, None)
-            if btn is None:
-                logger.warn(f'Unknown byte {hex(b)}')
-            release = bool(b & RELEASE_MASK)
-            reverse = bool(b & REVERSE_MASK)
-            logger.debug('Read: %s, rel=%s, rev=%s', btn, release, reverse)
-            return (btn, release, reverse)
+        return bs
+
+
+def decode(bs):
+    events = []
+    for b in bs:
+        btn = BYTEMAP.get(b & BUTTON_MASK, None)
+        if btn is None:
+            logger.warning('Unknown byte %#x', b)
+            continue
+        events.append((btn, bool(b & RELEASE_MASK), bool(b & REVERSE_MASK)))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Read: %s', events)
+    return events
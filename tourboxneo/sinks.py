@@ -0,0 +1,130 @@
+import logging
+import os
+
+from .listener import UnixListener
+from .writer import MemorySink, UInput
+
+logger = logging.getLogger(__name__)
+
+# Where the Emitter's batches go. A sink has send(buf), called once per syn
+# with every event of the batch already encoded as struct input_event, and
+# close().
+
+
+def open_uinput(codes=None):
+    from evdev import UInput, ecodes as e
+    if codes is None:
+        capabilities = {
+            e.EV_KEY: e.keys.keys(),
+            e.EV_REL: [
+                e.REL_WHEEL,
+                e.REL_HWHEEL,
+                e.REL_WHEEL_HI_RES,
+                e.REL_HWHEEL_HI_RES,
+            ],
+        }
+    else:
+        # never empty: evdev takes no capabilities to mean every key
+        capabilities = {e.EV_KEY: []}
+        for event, code in sorted(codes):
+            capabilities.setdefault(event, []).append(code)
+    device = UInput(capabilities,
+                    name='TourBoxNEO',
+                    vendor=0x0483,
+                    product=0x5740)
+    device.codes = None if codes is None else frozenset(codes)
+    return device
+
+
+# codes are the (event type, code) pairs the output must support; uinput
+# devices are created with just those, other sinks take anything.
+def open_sink(loop, spec, codes=None):
+    if spec == 'uinput':
+        return DeviceSink(open_uinput(codes))
+    if spec == 'raw':
+        return DeviceSink(UInput(codes))
+    if spec == 'memory':
+        return MemorySink()
+    if spec.startswith('unix:'):
+        return SocketSink(loop, spec[len('unix:'):])
+    raise RuntimeError(f'Unknown output: {spec}')
+
+
+def open_sinks(loop, specs, codes=None):
+    sinks = []
+    try:
+        for spec in specs:
+            sinks.append(open_sink(loop, spec, codes))
+    except Exception:
+        for sink in sinks:
+            sink.close()
+        raise
+    return sinks
+
+
+def grow_sinks(loop, specs, sinks, codes):
+    # devices can't gain capabilities, so one missing a code is replaced;
+    # they never shrink, a reload that drops a binding keeps the device
+    grown = []
+    for spec, sink in zip(specs, sinks):
+        have = getattr(sink, 'codes', None)
+        if have is not None and not codes <= have:
+            logger.info('Recreating %s output for %d new codes', spec,
+                        len(codes - have))
+            sink.close()
+            sink = open_sink(loop, spec, codes | have)
+        grown.append(sink)
+    return grown
+
+
+# A uinput device, either evdev's or writer.UInput.
+class DeviceSink:
+    def __init__(self, device):
+        self.device = device
+        self.fd = device.fd
+        self.codes = getattr(device, 'codes', None)
+
+    def send(self, buf):
+        os.write(self.fd, buf)
+
+    def close(self):
+        self.device.close()
+
+
+# Streams the raw input_event records to every connected client, e.g. a
+# bridge that replays them into a VM or container's own uinput device.
+# Clients that can't keep up are dropped rather than sent half a batch.
+class SocketSink:
+    def __init__(self, loop, path):
+        self.clients = []
+        self.listener = UnixListener(loop, path, self.connected)
+        logger.info('Streaming events to clients of %s', path)
+
+    def connected(self, conn):
+        conn.setblocking(False)
+        self.clients.append(conn)
+        logger.info('Event stream client connected')
+
+    def send(self, buf):
+        slow = None
+        for conn in self.clients:
+            try:
+                if conn.send(buf) == len(buf):
+                    continue
+            except OSError:
+                pass
+            slow = (slow or []) + [conn]
+        if slow:
+            for conn in slow:
+                self.drop(conn)
+
+    def drop(self, conn):
+        logger.warning('Event stream client dropped')
+        self.clients.remove(conn)
+        conn.close()
+
+    def close(self):
+        for conn in self.clients:
+            conn.close()
+        self.clients = []
+        self.listener.close()
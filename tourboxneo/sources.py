@@ -0,0 +1,168 @@
+import logging
+import os
+import struct
+import tty
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_MAGIC = b'TBXCAP\x00\x01'
+CAPTURE_RECORD = struct.Struct('<IH')  # microseconds since previous, length
+
+
+# Input backends besides the serial Reader. All of them hand the service a
+# readable fd, so they go through the same event loop and Service.tick path
+# as a real device.
+
+class FdReader:
+    def __init__(self, fd, name):
+        self.fd = fd
+        self.name = name
+
+    def __enter__(self):
+        logger.info('Starting %s', self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        logger.info('Halting %s', self.name)
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        try:
+            bs = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return b''
+        except OSError:
+            raise RuntimeError('Lost device')
+        if not bs:
+            self.eof()
+            raise RuntimeError('End of input')
+        return bs
+
+    def eof(self):
+        pass
+
+
+# A pseudo terminal: anything written to `path` reaches the service exactly
+# as if a TourBox had sent it.
+class PtyReader(FdReader):
+    def __init__(self):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        os.set_blocking(master, False)
+        super().__init__(master, 'pty reader')
+        self.slave = slave
+        self.path = os.ttyname(slave)
+        logger.warning('Feed input to %s', self.path)
+
+    def close(self):
+        super().close()
+        if self.slave is not None:
+            os.close(self.slave)
+            self.slave = None
+
+
+# Plays (delay, bytes) pairs from any iterable through a pipe, scheduled on
+# the loop. speed scales the delays; 0 plays as fast as the pipe drains.
+class GeneratorReader(FdReader):
+    def __init__(self, chunks, loop, speed=1, done=None):
+        r, w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        super().__init__(r, 'generator reader')
+        self.w = w
+        self.chunks = iter(chunks)
+        self.loop = loop
+        self.speed = speed
+        self.done = done
+        self.chunk = None
+        self.sent = 0
+        self.started = None
+
+    def __enter__(self):
+        super().__enter__()
+        self.started = monotonic()
+        self.loop.call_later(0, self.feed)
+        return self
+
+    def close(self):
+        super().close()
+        self.close_writer()
+
+    def close_writer(self):
+        if self.w is not None:
+            os.close(self.w)
+            self.w = None
+
+    def feed(self):
+        if self.w is None:
+            return
+        while True:
+            if self.chunk is None:
+                try:
+                    delay, self.chunk = next(self.chunks)
+                except StopIteration:
+                    self.close_writer()
+                    return
+                if self.speed and delay > 0:
+                    self.loop.call_later(delay / self.speed, self.feed)
+                    return
+            try:
+                n = os.write(self.w, self.chunk)
+            except BlockingIOError:
+                n = 0
+            self.sent += n
+            self.chunk = self.chunk[n:] or None
+            if self.chunk is not None:
+                # the service hasn't caught up, the rest goes once it has
+                self.loop.call_later(0.001, self.feed)
+                return
+
+    def eof(self):
+        elapsed = monotonic() - self.started
+        logger.warning('Played %d bytes in %.3fs (%.0f bytes/s)', self.sent,
+                    elapsed, self.sent / elapsed if elapsed else 0)
+        if self.done is not None:
+            self.done()
+
+
+class ReplayReader(GeneratorReader):
+    def __init__(self, path, loop, speed=1, done=None):
+        super().__init__(load_capture(path), loop, speed, done)
+        self.name = f'replay of {path}'
+
+
+def load_capture(path):
+    with open(path, 'rb') as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise RuntimeError(f'{path} is not a capture file')
+        while header := capture.read(CAPTURE_RECORD.size):
+            delta, length = CAPTURE_RECORD.unpack(header)
+            yield delta / 1e6, capture.read(length)
+
+
+class Recorder:
+    def __init__(self, path):
+        self.capture = open(path, 'wb')
+        self.capture.write(CAPTURE_MAGIC)
+        self.last = None
+
+    def record(self, bs):
+        now = monotonic()
+        delta = 0 if self.last is None else int((now - self.last) * 1e6)
+        self.last = now
+        for i in range(0, len(bs), 0xffff):
+            chunk = bs[i:i + 0xffff]
+            self.capture.write(CAPTURE_RECORD.pack(min(delta, 0xffffffff),
+                                                   len(chunk)))
+            self.capture.write(chunk)
+            delta = 0
+
+    def close(self):
+        self.capture.close()
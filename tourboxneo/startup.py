@@ -0,0 +1,78 @@
+import logging
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def profile_imports():
+    # a fresh interpreter is the only way to see imports the running one
+    # already paid for before main() was reached
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import tourboxneo.__main__'],
+        capture_output=True, text=True)
+    timings = []
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if m is None:
+            continue
+        self_us, cumulative_us, indent, name = m.groups()
+        depth = (len(indent) - 1) // 2
+        timings.append((name, depth, int(self_us), int(cumulative_us)))
+    return timings
+
+
+def profile_config(config_path, cache=True):
+    import toml
+    from .actions import Library
+    from .config import Config, load_cached, store_cached
+
+    timings = []
+    start = perf_counter()
+    config_path = Config.find(config_path)
+    text = config_path.read_bytes().decode('utf-8')
+    timings.append(('read ' + config_path.name, perf_counter() - start))
+
+    start = perf_counter()
+    data = toml.loads(text)
+    timings.append(('toml.loads', perf_counter() - start))
+
+    start = perf_counter()
+    Library()
+    timings.append(('Library()', perf_counter() - start))
+
+    start = perf_counter()
+    config = Config(data)
+    timings.append(('Config() incl. Library and layouts', perf_counter() - start))
+
+    if cache:
+        # timed from a scratch copy, the user's cache is left alone
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = Path(tmp_dir) / 'config.pickle'
+            store_cached(cache_path, config)
+            start = perf_counter()
+            load_cached(cache_path)
+            timings.append(('cached config', perf_counter() - start))
+    return timings
+
+
+def report(config_path, cache=True, out=sys.stdout):
+    imports = profile_imports()
+    total = sum(t[2] for t in imports)
+    print('imports (self / cumulative ms):', file=out)
+    for name, depth, self_us, cumulative_us in imports:
+        # top-level imports plus anything of ours, the rest is noise
+        if depth == 0 or name.startswith('tourboxneo'):
+            print(f'  {self_us / 1000:8.2f} {cumulative_us / 1000:8.2f}  '
+                  f'{"  " * depth}{name}', file=out)
+    print(f'  {total / 1000:8.2f}           total', file=out)
+
+    print('config (ms):', file=out)
+    for name, seconds in profile_config(config_path, cache):
+        print(f'  {seconds * 1000:8.2f}  {name}', file=out)
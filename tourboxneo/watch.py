@@ -0,0 +1,81 @@
+import ctypes
+import logging
+import os
+import struct
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+RELOAD_DELAY = 0.05  # editors tend to write a file in several steps
+
+
+# Watches a config file through inotify on its directory, so atomic saves
+# (write to a temporary file, rename over) are seen as well as in-place
+# writes. Parsing runs on a worker thread; only a config that loaded
+# cleanly is handed back to the loop.
+class ConfigWatcher:
+    def __init__(self, loop, path, callback, cache=True):
+        self.loop = loop
+        self.path = path
+        self.callback = callback
+        self.cache = cache
+        self.pending = None
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        directory = bytes(path.parent)
+        if libc.inotify_add_watch(fd, directory, mask) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        self.fd = fd
+        loop.add_reader(fd, self.receive)
+        logger.info('Watching %s for changes', path)
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+    def receive(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if os.fsdecode(name) == self.path.name:
+                    changed = True
+        if changed:
+            if self.pending is not None:
+                self.pending.cancel()
+            self.pending = self.loop.call_later(RELOAD_DELAY, self.reload)
+
+    def reload(self):
+        self.pending = None
+        Thread(target=self.parse, name='tourboxneo-reload', daemon=True).start()
+
+    def parse(self):
+        from .config import Config
+        try:
+            config = Config.from_file(self.path, cache=self.cache)
+        except Exception as err:
+            logger.error('Keeping the old config, %s is broken: %s',
+                         self.path, err)
+            return
+        self.loop.call_soon_threadsafe(self.callback, self.path, config)
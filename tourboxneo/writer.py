@@ -2,7 +2,6 @@ import logging
 import struct
 import os
 import fcntl
-from time import time as now
 
 logger = logging.getLogger(__name__)
 
@@ -29,25 +28,172 @@ REL_HWHEEL = 0x06
 REL_DIAL = 0x07
 REL_WHEEL = 0x08
 REL_MISC = 0x09
+REL_WHEEL_HI_RES = 0x0b
+REL_HWHEEL_HI_RES = 0x0c
+
+HIRES_DETENT = 120
+
+CODE_BITS = {EV_KEY: UI_SET_KEYBIT, EV_REL: UI_SET_RELBIT}
+
+# what a device is given when nobody says which codes it needs
+FULL_CODES = frozenset(
+    [(EV_KEY, key) for key in range(256)] +
+    [(EV_REL, rel) for rel in range(10)] +
+    [(EV_REL, REL_WHEEL_HI_RES), (EV_REL, REL_HWHEEL_HI_RES)])
 
 BUS_USB = 0x03
 
+# struct input_event; uinput ignores the timestamp and stamps events itself,
+# so templates leave it zeroed
+EVENT = struct.Struct('llHHi')
+SYN_REPORT = EVENT.pack(0, 0, EV_SYN, 0, 0)
+
+
+def encode(events):
+    return b''.join(EVENT.pack(0, 0, *ev) for ev in events)
+
+
+def encode_report(events):
+    if not events:
+        return b''
+    return encode(events) + SYN_REPORT
+
+
+class Emitter:
+    def __init__(self, sinks):
+        self.sinks = tuple(sinks)
+        self.pending = bytearray()
+        self.rel = None
+        self.rel_count = 0
+        self.wheels = {}  # rel code -> [hi-res fraction, legacy remainder]
+        self.dropped = 0  # reports a sink failed to take
+        self.failing = set()  # sinks whose last send failed
+
+    def emit(self, buf):
+        if self.rel is not None:
+            self.flush_rel()
+        self.pending += buf
+
+    def scroll(self, action, count):
+        if self.rel is not action:
+            if self.rel is not None:
+                self.flush_rel()
+            self.rel = action
+        self.rel_count += count
+
+    def flush_rel(self):
+        action = self.rel
+        wheel = self.wheels.get(action.rel, None)
+        if wheel is None:
+            wheel = self.wheels[action.rel] = [0.0, 0]
+
+        # fractional steps accumulate until they make up a hi-res unit, and
+        # hi-res units until they make up a legacy detent
+        total = wheel[0] + action.step * self.rel_count * HIRES_DETENT
+        hires = int(total)
+        wheel[0] = total - hires
+        if hires:
+            if (wheel[1] < 0) != (hires < 0):
+                wheel[1] = 0  # direction changed, drop the partial detent
+            legacy = wheel[1] + hires
+            detents = int(legacy / HIRES_DETENT)
+            wheel[1] = legacy - detents * HIRES_DETENT
+            self.pending += action.report(hires, detents)
+
+        self.rel = None
+        self.rel_count = 0
+
+    def syn(self):
+        if self.rel is not None:
+            self.flush_rel()
+        pending = self.pending
+        if not pending:
+            return
+        if not pending.endswith(SYN_REPORT):
+            pending += SYN_REPORT
+        try:
+            self.send(pending)
+        finally:
+            pending.clear()
+
+    def send(self, buf):
+        # the whole batch, once per sink; a failing sink drops it, the
+        # others still get it and nobody gets it twice
+        for sink in self.sinks:
+            try:
+                sink.send(buf)
+            except OSError as err:
+                self.dropped += 1
+                if sink not in self.failing:
+                    self.failing.add(sink)
+                    logger.error('Output %s failed, dropping reports: %s',
+                                 type(sink).__name__, err)
+                continue
+            if self.failing and sink in self.failing:
+                self.failing.discard(sink)
+                logger.warning('Output %s is back', type(sink).__name__)
 
+
+# Keeps what would have gone to a device (tests, benchmarks).
+class MemorySink:
+    def __init__(self, keep=True):
+        self.keep = keep
+        self.data = bytearray()
+        self.writes = 0
+        self.written = 0
+
+    def send(self, buf):
+        self.writes += 1
+        self.written += len(buf)
+        if self.keep:
+            self.data += buf
+
+    def close(self):
+        pass
+
+    def events(self):
+        data = self.data
+        return [EVENT.unpack_from(data, i)[2:]
+                for i in range(0, len(data), EVENT.size)]
+
+
+# An Emitter with nothing but a MemorySink behind it.
+class MemoryWriter(Emitter):
+    def __init__(self, keep=True):
+        self.memory = MemorySink(keep)
+        super().__init__([self.memory])
+
+    @property
+    def data(self):
+        return self.memory.data
+
+    @property
+    def writes(self):
+        return self.memory.writes
+
+    @property
+    def written(self):
+        return self.memory.written
+
+    def events(self):
+        return self.memory.events()
+
+
+# A uinput device set up by hand, without evdev.
 class UInput:
-    def __init__(self):
+    def __init__(self, codes=None):
         if not os.path.exists('/dev/uinput'):
             raise IOError('No uinput module found.')
 
-        uinput = open('/dev/uinput', 'wb')
-        fcntl.ioctl(uinput, UI_SET_EVBIT, EV_KEY)
-        fcntl.ioctl(uinput, UI_SET_EVBIT, EV_REL)
-        fcntl.ioctl(uinput, UI_SET_EVBIT, EV_REP)
-        # e.EV_KEY: e.keys.keys(),
+        if codes is None:
+            codes = FULL_CODES
+        self.codes = frozenset(codes)
 
-        for i in range(256):
-            fcntl.ioctl(uinput, UI_SET_KEYBIT, i)
-        for i in range(10):
-            fcntl.ioctl(uinput, UI_SET_RELBIT, i)
+        uinput = open('/dev/uinput', 'wb')
+        for event in sorted({t for t, _ in self.codes} | {EV_REP}):
+            fcntl.ioctl(uinput, UI_SET_EVBIT, event)
+        for event, code in sorted(self.codes):
+            fcntl.ioctl(uinput, CODE_BITS[event], code)
 
         fmt = '80sHHHHi64i64i64i64i'
         axis = [0] * 64 * 4
@@ -59,26 +205,10 @@ class UInput:
         uinput.flush() # Without this you may get Errno 22: Invalid argument.
 
         fcntl.ioctl(uinput, UI_DEV_CREATE)
-        #fcntl.ioctl(uinput, UI_DEV_DESTROY)
 
         self.uinput = uinput
+        self.fd = uinput.fileno()
 
-    def cur_time(self):
-        integer, fraction = divmod(now(), 1)
-        s = int(integer)
-        ms = int(fraction * 1e6)
-        return s, ms
-
-    def write(self, event, code, value):
-        fmt = 'llHHI'
-        s, ms = self.cur_time()
-        ev = struct.pack(fmt, s, ms, event, code, value)
-        self.uinput.write(ev)
-        self.uinput.flush()
-
-    def syn(self):
-        fmt = 'llHHI'
-        s, ms = self.cur_time()
-        ev = struct.pack(fmt, s, ms, EV_SYN, 0, 0)
-        self.uinput.write(ev)
-        self.uinput.flush()
+    def close(self):
+        fcntl.ioctl(self.uinput, UI_DEV_DESTROY)
+        self.uinput.close()